@@ -38,9 +38,8 @@ print("")
 data_train = np.vstack([dataset1['data']]) #, dataset2['data'], dataset3['data'], dataset4['data'], dataset5['data']])
 labels_train = np.hstack([dataset1['labels']]) #, dataset2['labels'], dataset3['labels'], dataset4['labels'], dataset5['labels']])
 
-data_train = data_train.astype('float') / 255.
-labels_train = labels_train
-data_test = dataset0['data'].astype('float') / 255.
+# Images are kept as uint8, and only scaled to floats within the network.
+data_test = dataset0['data']
 labels_test = np.array(dataset0['labels'])
 
 n_feat = data_train.shape[1]
@@ -60,6 +59,7 @@ nn = mlp.Classifier(
         learning_rate=0.002,
         learning_rule="momentum",
         valid_size=0.1,
+        input_scale=1.0/255.0,
         verbose=1)
 
 if PRETRAIN:
@@ -71,7 +71,7 @@ if PRETRAIN:
             learning_rate=0.002,
             n_iter=10,
             verbose=1)
-    ae.fit(data_train)
+    ae.fit(data_train.astype('float') / 255.)
     ae.transfer(nn)
 
 nn.fit(data_train, labels_train)
@@ -8,18 +8,25 @@ import sys
 import math
 import time
 import types
+import atexit
+import shutil
+import tempfile
 import logging
 import itertools
+import contextlib
+import collections
+import multiprocessing
 
 log = logging.getLogger('sknn')
 
 
 import numpy
+import scipy.sparse
 import theano
+import theano.sparse
 import sklearn.base
 import sklearn.pipeline
 import sklearn.preprocessing
-import sklearn.cross_validation
 
 import theano.tensor as T
 import lasagne.layers
@@ -27,12 +34,36 @@ import lasagne.nonlinearities as nl
 
 from ..base import BaseBackend
 from ...nn import Layer, Convolution, Native, ansi
+from ...data import BatchPrefetcher, ChunkStream, AugmentationPool
+
+
+# Directories of disk snapshots that still exist, removed by a single handler at exit.
+_snapshot_dirs = set()
+
+
+@atexit.register
+def _remove_snapshot_dirs():
+    for directory in list(_snapshot_dirs):
+        shutil.rmtree(directory, ignore_errors=True)
+    _snapshot_dirs.clear()
 
 
 def explin(x):
     return x * (x>=0) + (x<0) * (T.exp(x) - 1)
 
 
+class SparseDenseLayer(lasagne.layers.DenseLayer):
+    """Fully connected layer that receives a sparse matrix as input, which is multiplied by
+    the weights with a structured dot product so the cost scales with the non-zero entries.
+    """
+
+    def get_output_for(self, input, **kwargs):
+        activation = theano.sparse.structured_dot(input, self.W)
+        if self.b is not None:
+            activation = activation + self.b.dimshuffle('x', 0)
+        return self.nonlinearity(activation)
+
+
 class MultiLayerPerceptronBackend(BaseBackend):
     """
     Abstract base class for wrapping the multi-layer perceptron functionality
@@ -46,6 +77,41 @@ class MultiLayerPerceptronBackend(BaseBackend):
         self.trainer = None
         self.validator = None
         self.regularizer = None
+        self.input_dtype = None
+        self.stall_time = 0.0
+        self.augment_stats = collections.Counter()
+        self.augment_pool = (None, None)
+        self.device_data = {}
+        self.device_sources = {}
+        self.fused_trainer = None
+        self.train_split = None
+        self.valid_split = None
+        self.epoch_source = None
+        self.epoch_order = None
+        self.epoch_offset = 0
+        self.sampling_cache = (None, None)
+        self.sample_losses = None
+        self.loss_table = None
+        self.loss_source = None
+        self.loss_epochs = 0
+        self.snapshot = None
+        self.valid_subset = (None, None)
+        self.interrupted = False
+        self.batch_position = 0
+        self.resume_position = None
+        self.skip_batches = 0
+        self.deadline = None
+        self.timed_out = False
+        self.rate_shared = None
+        self.train_updates = None
+        self.grad_buffers = None
+        self.grad_count = None
+        self.grad_updates = None
+        self.apply_gradients = None
+        self.momentum_shared = None
+        self.schedule_epoch = 0
+        self.loss_accumulator = theano.shared(numpy.asarray(0.0, dtype=numpy.float64), name='loss')
+        self.loss_count = 0
 
     def _create_mlp_trainer(self, params):
         # Aggregate all regularization parameters into common dictionaries.
@@ -81,27 +147,198 @@ class MultiLayerPerceptronBackend(BaseBackend):
         return self._create_trainer_function(params, cost_symbol)
 
     def _create_trainer_function(self, params, cost):
+        # Both are shared variables, so schedules can change them without compiling again.
+        self.rate_shared = theano.shared(numpy.asarray(self.learning_rate, dtype=theano.config.floatX),
+                                         name='learning_rate')
+        self.momentum_shared = theano.shared(numpy.asarray(self.learning_momentum, dtype=theano.config.floatX),
+                                             name='momentum')
+
+        loss_or_grads = cost
+        if self.accumulate_steps:
+            assert not self.fused_steps, "Gradient accumulation is not supported with `fused_steps`."
+            loss_or_grads = self._create_gradient_buffers(params, cost)
+
         if self.learning_rule in ('sgd', 'adagrad', 'adadelta', 'rmsprop', 'adam'):
             lr = getattr(lasagne.updates, self.learning_rule)
-            self._learning_rule = lr(cost, params, learning_rate=self.learning_rate)
+            self._learning_rule = lr(loss_or_grads, params, learning_rate=self.rate_shared)
         elif self.learning_rule in ('momentum', 'nesterov'):
             lasagne.updates.nesterov = lasagne.updates.nesterov_momentum
             lr = getattr(lasagne.updates, self.learning_rule)
-            self._learning_rule = lr(cost, params, learning_rate=self.learning_rate, momentum=self.learning_momentum)
+            self._learning_rule = lr(loss_or_grads, params, learning_rate=self.rate_shared, momentum=self.momentum_shared)
         else:
             raise NotImplementedError(
                 "Learning rule type `%s` is not supported." % self.learning_rule)
 
-        trainer = theano.function([self.data_input, self.data_output, self.data_mask], cost,
-                                   updates=self._learning_rule,
+        # With accumulation, each batch only adds to the buffers and the update is separate.
+        self.train_updates = list(self._learning_rule.items())
+        if self.accumulate_steps:
+            reset = [(b, T.zeros_like(b)) for b in self.grad_buffers + [self.grad_count]]
+            self.apply_gradients = theano.function([], [], updates=self.train_updates + reset)
+            self.train_updates = self.grad_updates
+
+        compare = self.cost_function(self.network_output, self.data_correct).mean()
+        outputs = []
+        if self.sampling == 'loss':
+            assert not self.fused_steps, "Loss-based sampling is not supported with `fused_steps`."
+            # The trainer returns the loss of each example, to update the table of losses.
+            outputs = self._example_cost(self.trainer_output, self.data_output)
+            self.sample_losses = theano.function([self.data_input, self.data_correct],
+                                                 self._example_cost(self.network_output, self.data_correct),
+                                                 allow_input_downcast=True)
+        if self.device_resident:
+            return self._create_device_functions(cost, compare, outputs)
+
+        size = self.data_input.shape[0]
+        updates = self.train_updates + self._accumulate_loss(cost, size)
+        trainer = theano.function([self.data_input, self.data_output, self.data_mask], outputs,
+                                   updates=updates,
                                    on_unused_input='ignore',
                                    allow_input_downcast=True)
 
-        compare = self.cost_function(self.network_output, self.data_correct).mean()
-        validator = theano.function([self.data_input, self.data_correct], compare,
+        if self.fused_steps:
+            inputs = [self.data_input, self.data_output, self.data_mask]
+            sequences = [T.TensorType(v.dtype, (False,) + v.broadcastable)(v.name + 's') for v in inputs]
+            self.fused_trainer = self._create_fused_trainer(cost, sequences, lambda *b: dict(zip(inputs, b)))
+
+        validator = theano.function([self.data_input, self.data_correct], [],
+                                    updates=self._accumulate_loss(compare, size),
                                     allow_input_downcast=True)
         return trainer, validator
 
+    def _create_gradient_buffers(self, params, cost):
+        """Create shared buffers that sum the gradients of consecutive batches, each weighted
+        by its number of samples, and the updates that add to them.  Returns the average
+        gradients over all the accumulated samples, for the learning rule to apply at once.
+        """
+        size = T.cast(self.data_input.shape[0], theano.config.floatX)
+        self.grad_buffers = [theano.shared(numpy.zeros_like(p.get_value()), name='accumulated_' + str(p.name))
+                             for p in params]
+        self.grad_count = theano.shared(numpy.asarray(0.0, dtype=theano.config.floatX), name='accumulated')
+
+        grads = theano.grad(cost, params)
+        self.grad_updates = [(b, b + g * size) for b, g in zip(self.grad_buffers, grads)]
+        self.grad_updates.append((self.grad_count, self.grad_count + size))
+        return [b / self.grad_count for b in self.grad_buffers]
+
+    def _accumulate_loss(self, cost, size):
+        """Updates that add the loss of a batch, weighted by its number of samples, to the
+        accumulator on the device.  The compiled functions then return no loss, which avoids
+        a transfer to the host for every batch.  The sum is kept in double precision, so it
+        stays accurate over epochs of many millions of samples.
+        """
+        return [(self.loss_accumulator, self.loss_accumulator + T.cast(cost, 'float64') * T.cast(size, 'float64'))]
+
+    def _schedules(self):
+        return [(s, v, i) for s, v, i in ((self.learning_schedule, self.rate_shared, self.learning_rate),
+                                          (self.momentum_schedule, self.momentum_shared, self.learning_momentum))
+                if s is not None]
+
+    def _update_schedules(self, epoch, progress=0.0):
+        """Assign the values of the schedules at the given epoch, plus the fraction of it that
+        was completed, to the shared variables of the trainer.
+        """
+        self.schedule_epoch = epoch
+        for schedule, shared, initial in self._schedules():
+            if progress == 0.0 or schedule.per_batch:
+                shared.set_value(numpy.asarray(schedule(initial, epoch + progress), dtype=shared.dtype))
+
+    def _observe_schedules(self, error):
+        for schedule, _, _ in self._schedules():
+            schedule.observe(error)
+
+    def _reset_loss(self):
+        self.loss_accumulator.set_value(numpy.asarray(0.0, dtype=numpy.float64))
+        self.loss_count = 0
+
+    def _read_loss(self):
+        """Transfer the accumulated loss from the device, returning the average loss of all
+        samples processed since the last reset, or ``None`` if there were no samples.  The
+        number of samples is counted on the host, as it's known for every batch.
+        """
+        if self.loss_count == 0:
+            return None
+        return float(self.loss_accumulator.get_value()) / self.loss_count
+
+    def _example_cost(self, output, target):
+        # Reduce the loss over all outputs, but not over the examples in the batch.
+        cost = self.cost_function(output, target)
+        return cost.flatten(2).mean(axis=1) if cost.ndim > 1 else cost
+
+    def _create_device_functions(self, cost, compare, outputs):
+        """Compile the trainer and validator to read their data from shared variables that
+        are loaded once, so each call only needs the vector of indices in the batch.
+        """
+        def placeholder(var):
+            return theano.shared(numpy.zeros((0,) * var.ndim, dtype=var.dtype), borrow=True)
+
+        indices = T.lvector('i')
+        Xs, ys = placeholder(self.data_input), placeholder(self.data_output)
+        if self.data_mask.ndim > 0:
+            ws = placeholder(self.data_mask)
+            mask = ws[indices]
+        else:
+            ws, mask = None, T.constant(numpy.asarray(1.0, dtype=theano.config.floatX))
+
+        updates = self.train_updates + self._accumulate_loss(cost, indices.shape[0])
+        trainer = theano.function([indices], outputs,
+                                  updates=updates,
+                                  givens={self.data_input: Xs[indices],
+                                          self.data_output: ys[indices],
+                                          self.data_mask: mask},
+                                  on_unused_input='ignore')
+
+        if self.valid_split is not None:
+            # Validation samples are selected by index from the same arrays as training.
+            Xv, yv = Xs, ys
+        else:
+            Xv, yv = placeholder(self.data_input), placeholder(self.data_correct)
+        validator = theano.function([indices], [],
+                                    updates=self._accumulate_loss(compare, indices.shape[0]),
+                                    givens={self.data_input: Xv[indices],
+                                            self.data_correct: yv[indices]})
+
+        self.device_data = {trainer: [Xs, ys, ws], validator: [Xv, yv]}
+
+        if self.fused_steps:
+            self.fused_trainer = self._create_fused_trainer(
+                                    cost, [T.lmatrix('is')],
+                                    lambda i: {self.data_input: Xs[i],
+                                               self.data_output: ys[i],
+                                               self.data_mask: ws[i] if ws is not None else mask})
+        return trainer, validator
+
+    def _create_fused_trainer(self, cost, sequences, replace):
+        """Compile a trainer that performs ``fused_steps`` consecutive updates within a single
+        call using ``theano.scan``, accumulating the loss of all steps.  The ``replace`` function
+        maps the slices of the ``sequences`` for one step to the variables of the cost.
+        """
+        def step(*batch):
+            outputs = theano.clone([cost] + list(self._learning_rule.values()), replace=replace(*batch))
+            return outputs[0], collections.OrderedDict(zip(self._learning_rule.keys(), outputs[1:]))
+
+        losses, updates = theano.scan(step, sequences=sequences)
+        # All the fused steps process full batches, so the samples are weighted equally.
+        updates.update(self._accumulate_loss(losses.mean(), sequences[0].shape[0] * sequences[0].shape[1]))
+        return theano.function(sequences, [],
+                               updates=updates,
+                               on_unused_input='ignore',
+                               allow_input_downcast=True)
+
+    def _load_device_data(self, processor, arrays):
+        """Upload the arrays into the shared variables of this function, unless the same
+        arrays were already loaded into those variables previously.
+        """
+        for shared, array in zip(self.device_data[processor], arrays):
+            if shared is None or self.device_sources.get(shared, None) is array:
+                continue
+            assert isinstance(array, numpy.ndarray),\
+                "Only numpy arrays can be stored on the device, not `%s`." % type(array).__name__
+            data = numpy.asarray(array, dtype=shared.dtype)
+            if data is not array:
+                self.copied_bytes['device'] += data.nbytes
+            shared.set_value(data, borrow=True)
+            self.device_sources[shared] = array
+
     def _get_activation(self, l):
         nonlinearities = {'Rectifier': nl.rectify,
                           'Sigmoid': nl.sigmoid,
@@ -162,17 +399,44 @@ class MultiLayerPerceptronBackend(BaseBackend):
             return self._create_convolution_layer(name, layer, network)
 
         self._check_layer(layer, required=['units'])
-        network = lasagne.layers.DenseLayer(network,
-                                            num_units=layer.units,
-                                            nonlinearity=self._get_activation(layer))
+        sparse = self.sparse_input and isinstance(network, lasagne.layers.InputLayer)
+        dense_layer = SparseDenseLayer if sparse else lasagne.layers.DenseLayer
+        network = dense_layer(network,
+                              num_units=layer.units,
+                              nonlinearity=self._get_activation(layer))
 
         normalize = layer.normalize or self.normalize
         if normalize == 'batch':
             network = lasagne.layers.batch_norm(network)
         return network
 
+    def _scale_input(self, data):
+        # Compact integer inputs are only converted within the graph, then scaled and offset.
+        if self.input_dtype == theano.config.floatX and self.input_scale is None and self.input_offset is None:
+            return data
+        data = T.cast(data, theano.config.floatX)
+        if self.input_scale is not None:
+            data = data * numpy.asarray(self.input_scale, dtype=theano.config.floatX)
+        if self.input_offset is not None:
+            data = data + numpy.asarray(self.input_offset, dtype=theano.config.floatX)
+        return data
+
     def _create_mlp(self, X, w=None):
-        self.data_input = T.tensor4('X') if self.is_convolution(input=True) else T.matrix('X')
+        compact = X.dtype.name in ('uint8', 'uint16') and not self.sparse_input
+        self.input_dtype = X.dtype.name if compact else theano.config.floatX
+        tensor = T.tensor4 if self.is_convolution(input=True) else T.matrix
+        self.data_input = tensor('X', dtype=self.input_dtype)
+        if self.sparse_input:
+            first = self.layers[0]
+            assert type(first) is Layer and not (first.dropout or self.dropout_rate),\
+                "Sparse input requires a standard `Layer` first, without dropout."
+            assert not self.fused_steps and not self.device_resident,\
+                "Sparse input is not supported with `fused_steps` or `device_resident`."
+            assert self.input_scale is None and self.input_offset is None,\
+                "Sparse input is not supported with `input_scale` or `input_offset`."
+            self.data_input = theano.sparse.csr_matrix('X', dtype=theano.config.floatX)
+        assert self.augment is None or not (self.sparse_input or self.device_resident),\
+            "Augmentation requires dense batches, without `sparse_input` or `device_resident`."
         self.data_output = T.tensor4('y') if self.is_convolution(output=True) else T.matrix('y')
         self.data_mask = T.vector('m') if w is not None else T.scalar('m')
         self.data_correct = T.matrix('yp')
@@ -180,7 +444,7 @@ class MultiLayerPerceptronBackend(BaseBackend):
         lasagne.random.get_rng().seed(self.random_state)
 
         shape = list(X.shape)
-        network = lasagne.layers.InputLayer([None]+shape[1:], self.data_input)
+        network = lasagne.layers.InputLayer([None]+shape[1:], self._scale_input(self.data_input))
 
         # Create the layers one by one, connecting to previous.
         self.mlp = []
@@ -245,12 +509,11 @@ class MultiLayerPerceptronBackend(BaseBackend):
             return
 
         if self.valid_size > 0.0:
+            # The data is split by sorted indices into the same arrays, rather than copied.
             assert self.valid_set is None, "Can't specify valid_size and valid_set together."
-            X, X_v, y, y_v = sklearn.cross_validation.train_test_split(
-                                X, y,
-                                test_size=self.valid_size,
-                                random_state=self.random_state)
-            self.valid_set = X_v, y_v
+            train, valid = self._split_validation(y)
+            self.train_split, self.valid_split = (X, train), (X, valid)
+            self.valid_set = X, y
 
         if self.valid_set and self.is_convolution():
             X_v, y_v = self.valid_set
@@ -265,6 +528,40 @@ class MultiLayerPerceptronBackend(BaseBackend):
         self.trainer, self.validator = self._create_mlp_trainer(params)
         return X, y
 
+    def _split_validation(self, y):
+        """Randomly select the indices of samples for training and validation, stratified
+        by the label of the first output for classifiers, unless the classes are too small
+        to provide samples for both.  Both are sorted for locality.
+        """
+        if self.is_classifier:
+            labels = self._class_labels(y)
+        else:
+            labels = numpy.zeros((y.shape[0],), dtype=numpy.int8)
+
+        rng = numpy.random.RandomState(self.random_state)
+        train, valid = [], []
+        for label in numpy.unique(labels):
+            members = numpy.flatnonzero(labels == label)
+            rng.shuffle(members)
+            split = int(round(len(members) * self.valid_size))
+            valid.append(members[:split])
+            train.append(members[split:])
+
+        train, valid = numpy.sort(numpy.concatenate(train)), numpy.sort(numpy.concatenate(valid))
+        if len(train) == 0 or len(valid) == 0:
+            # Classes too small to be split individually are split together instead.
+            members = rng.permutation(y.shape[0])
+            split = int(math.ceil(y.shape[0] * self.valid_size))
+            train, valid = numpy.sort(members[split:]), numpy.sort(members[:split])
+        if len(train) == 0 or len(valid) == 0:
+            raise ValueError("Dataset of %i samples is too small for a validation split with `valid_size=%r`."
+                             % (y.shape[0], self.valid_size))
+        return train, valid
+
+    def _class_labels(self, y):
+        # The label index of the first output, from its columns of the one-hot encoding.
+        return y[:, :len(self.label_binarizers[0].classes_)].argmax(axis=1)
+
     def _predict_impl(self, X):
         if self.is_convolution():
             X = numpy.transpose(X, (0, 3, 1, 2))
@@ -281,64 +578,461 @@ class MultiLayerPerceptronBackend(BaseBackend):
             y[idx] = yb
         return y
 
-    def _iterate_data(self, batch_size, X, y=None, w=None, shuffle=False):
-        def cast(array, indices):
-            if array is None:
-                return None
-
-            # Support for pandas.DataFrame, requires custom indexing.
-            if type(array).__name__ == 'DataFrame':
-                array = array.loc[indices]
-            else:
-                array = array[indices]
+    def _iterate_excerpts(self, batch_size, total_size, shuffle=False, indices=None, chunk=None):
+        """Generate the selection of samples for each batch, either a ``slice`` for
+        contiguous samples or an array of indices when samples are shuffled individually.
+        The ``chunk`` shuffle mode only permutes samples within chunks of ``chunk`` samples,
+        and the order of these chunks, which keeps reads from memory-mapped files local.
+        If a subset of ``indices`` is specified, the selection is made only from those, and
+        they are checked once here so the batches can then be gathered without checks.
+        """
+        if indices is not None:
+            indices = numpy.asarray(indices)
+            if len(indices) and (indices.min() < 0 or indices.max() >= total_size):
+                raise IndexError("Sample indices are out of range for %i samples." % total_size)
+            for excerpt in self._iterate_excerpts(batch_size, len(indices), shuffle, chunk=chunk):
+                yield indices[excerpt]
+            return
 
-                # Support for scipy.sparse; convert after slicing.
-                if hasattr(array, 'todense'):
-                    array = array.todense()
+        starts = numpy.arange(0, total_size, chunk if shuffle == 'chunk' else batch_size)
+        if shuffle in ('block', 'chunk'):
+            numpy.random.shuffle(starts)
+
+        if shuffle == 'chunk':
+            for c in starts:
+                order = numpy.arange(c, min(c + chunk, total_size))
+                numpy.random.shuffle(order)
+                for s in range(0, len(order), batch_size):
+                    yield order[s:s + batch_size]
+        elif shuffle and shuffle != 'block':
+            order = numpy.arange(total_size)
+            numpy.random.shuffle(order)
+            for s in starts:
+                yield order[s:s + batch_size]
+        else:
+            for s in starts:
+                yield slice(s, min(s + batch_size, total_size))
 
-            return array.astype(theano.config.floatX)
+    def _chunk_size(self, X, batch_size):
+        """Number of samples in a chunk for local shuffling, a multiple of the batch size
+        covering roughly 64 MB of contiguous input data.
+        """
+        row = X.dtype.itemsize * int(numpy.prod(X.shape[1:]))
+        return max(1, (64 * 2**20) // (row * batch_size)) * batch_size
+
+    def _iterate_data(self, batch_size, X, y=None, w=None, shuffle=False, copy=False, ring=1,
+                      indices=None, chunk=None, pool=None, skip=0):
+        """Generate minibatches as ``(Xb, yb, wb, excerpt)`` tuples from the dataset.
+
+        Contiguous arrays already stored as ``floatX`` are sliced into views without any
+        copies, unless ``copy`` is set.  Other inputs are gathered into buffers that are
+        allocated once and reused, so each batch is only valid until the next is yielded.
+        The ``shuffle`` mode can be ``True`` or ``full`` for sample-level shuffling, or
+        ``block`` to only shuffle the order of contiguous blocks of ``batch_size``.
+        Setting ``ring`` cycles through multiple buffers, e.g. when batches are prefetched.
+        See ``_iterate_excerpts()`` for the ``indices`` and ``chunk`` parameters.  If an
+        augmentation ``pool`` is specified, the inputs are taken from its shared buffers.
+        The first ``skip`` batches are selected but not gathered.
+        """
+        buffers = {}
+        input_dtype = self.input_dtype or theano.config.floatX
+        if input_dtype != theano.config.floatX:
+            assert X.dtype == input_dtype,\
+                "The network was initialized for inputs of type `%s`, not `%s`." % (input_dtype, X.dtype)
+
+        def gather(array, excerpt, key):
+            dtype = numpy.dtype(input_dtype if key[0] == 'X' else theano.config.floatX)
+            count = (excerpt.stop - excerpt.start) if isinstance(excerpt, slice) else len(excerpt)
+            if key not in buffers:
+                buffers[key] = numpy.empty((batch_size,) + array.shape[1:], dtype=dtype)
+            buf = buffers[key][:count]
+
+            if isinstance(excerpt, slice):
+                numpy.copyto(buf, array[excerpt], casting='unsafe')
+            elif array.dtype == dtype:
+                # Indices were checked for the whole epoch, and clipping avoids a temporary copy.
+                numpy.take(array, excerpt, axis=0, out=buf, mode='clip')
+            else:
+                # Stage the samples with the source type, then convert them in place.
+                stage = key + ('stage',)
+                if stage not in buffers:
+                    buffers[stage] = numpy.empty((batch_size,) + array.shape[1:], dtype=array.dtype)
+                numpy.take(array, excerpt, axis=0, out=buffers[stage][:count], mode='clip')
+                numpy.copyto(buf, buffers[stage][:count], casting='unsafe')
+            self.copied_bytes['batches'] += buf.nbytes
+            return buf
+
+        def cast(array, excerpt, key):
+            if array is None:
+                return None
 
-        total_size = X.shape[0]
-        indices = numpy.arange(total_size)
-        if shuffle:
-            numpy.random.shuffle(indices)
+            # Support for scipy.sparse; keep as CSR for sparse input, otherwise convert after slicing.
+            if self.sparse_input and key[0] == 'X':
+                batch = scipy.sparse.csr_matrix(array[excerpt])
+                return batch if batch.dtype == theano.config.floatX else batch.astype(theano.config.floatX)
+            if hasattr(array, 'todense'):
+                batch = array[excerpt].toarray().astype(theano.config.floatX)
+                self.copied_bytes['batches'] += batch.nbytes
+                return batch
+
+            # Contiguous blocks of the right type are passed through as views.
+            dtype = input_dtype if key[0] == 'X' else theano.config.floatX
+            if isinstance(excerpt, slice) and not copy and array.flags.c_contiguous and array.dtype == dtype:
+                return array[excerpt]
+            return gather(array, excerpt, key)
+
+        excerpts = self._iterate_excerpts(batch_size, X.shape[0], shuffle, indices, chunk)
+        excerpts = itertools.islice(excerpts, skip, None)
+        batches = pool.iterate(excerpts) if pool is not None else ((None, e) for e in excerpts)
+        for i, (Xb, excerpt) in enumerate(batches):
+            slot = i % ring
+            if Xb is None:
+                Xb = cast(X, excerpt, ('X', slot))
+            yield Xb, cast(y, excerpt, ('y', slot)), cast(w, excerpt, ('w', slot)), excerpt
+
+    @contextlib.contextmanager
+    def _augmentation(self, X):
+        """Start the pool of augmentation workers once for all the epochs of training on the
+        inputs ``X``, then stop the workers and record their statistics when training ends.
+        """
+        if self.augment is None or self._augment_workers() == 0 or not isinstance(X, numpy.ndarray):
+            yield
+            return
 
-        for index in range(0, total_size, batch_size):
-            excerpt = indices[index:index + batch_size]
-            Xb, yb, wb = cast(X, excerpt), cast(y, excerpt), cast(w, excerpt)
-            yield Xb, yb, wb, excerpt
+        steps = self.fused_steps or 1
+        ring = self.prefetch + 2 if self.prefetch else 1
+        pool = AugmentationPool(X, self.augment, self.batch_size * steps, self.input_dtype,
+                                self._augment_workers(), ring=ring)
+        self.augment_pool = (X, pool)
+        try:
+            yield
+        finally:
+            self.augment_pool = (None, None)
+            pool.close()
+            self.augment_stats['batches'] += pool.batches
+            self.augment_stats['time'] += time.time() - pool.start_time
+            self.augment_stats['stall'] += pool.stall_time
+
+    def _augment_workers(self):
+        if not hasattr(os, 'fork'):
+            return 0
+        if self.augment_workers is not None:
+            return self.augment_workers
+        return max(1, multiprocessing.cpu_count() - 1)
 
     def _print(self, text):
         if self.verbose:
             sys.stdout.write(text)
             sys.stdout.flush()
 
-    def _batch_impl(self, X, y, w, processor, mode, output, shuffle):
-        progress, batches = 0, X.shape[0] / self.batch_size
-        loss, count = 0.0, 0
-        for Xb, yb, wb, _ in self._iterate_data(self.batch_size, X, y, w, shuffle):
-            self._do_callback('on_batch_start', locals())
-
-            if mode == 'train':
-                loss += processor(Xb, yb, wb if wb is not None else 1.0)
-            else:
-                loss += processor(Xb, yb)
+    def _process_batch(self, processor, args, steps):
+        """Call the compiled function for a group of ``steps`` batches, using the fused trainer
+        if the group is complete.  Returns the number of batches processed.
+        """
+        if steps == 1:
+            processor(*args)
+            return 1
+
+        total = len(args[0])
+        if total == steps * self.batch_size:
+            shape = (steps, self.batch_size)
+            fused = [a.reshape(shape + a.shape[1:]) if numpy.ndim(a) else numpy.full((steps,), a) for a in args]
+            self.fused_trainer(*fused)
+            return steps
+
+        # The last group may be partial, so process its remaining batches one by one.
+        count = 0
+        for s in range(0, total, self.batch_size):
+            processor(*[a[s:s + self.batch_size] if numpy.ndim(a) else a for a in args])
             count += 1
+        return count
+
+    def _batch_variables(self, X, y, w, Xb, yb, wb, excerpt, mode, batch):
+        # Fixed set of variables passed to batch callbacks, only built if there are subscribers.
+        size = (excerpt.stop - excerpt.start) if isinstance(excerpt, slice) else len(excerpt)
+        return {'X': X, 'y': y, 'w': w, 'Xb': Xb, 'yb': yb, 'wb': wb,
+                'excerpt': excerpt, 'mode': mode, 'batch': batch, 'size': size}
+
+    def _batch_impl(self, X, y, w, processor, mode, output, shuffle, indices=None, store_losses=False):
+        total_size = X.shape[0] if indices is None else len(indices)
+        progress, batches = 0, total_size / self.batch_size
+        count = 0
+
+        # Losses are accumulated on the device since the last reset, and only read back at the end.
+        per_batch = mode == 'train' and any(s.per_batch for s, _, _ in self._schedules())
+        accumulate = self.accumulate_steps if mode == 'train' else None
+        deadline = self.deadline if mode == 'train' else None
+
+        # Groups of batches are selected together when multiple training steps are fused.
+        steps = (self.fused_steps or 1) if mode == 'train' else 1
+        batch_size = self.batch_size * steps
+
+        # An epoch resumed after termination skips the groups of batches it had processed.
+        skip = 0
+        if mode == 'train' and self.skip_batches:
+            skip = min(self.skip_batches, -(-total_size // batch_size))
+            self.skip_batches -= skip
+            self.batch_position += skip
+            count = -(-min(skip * batch_size, total_size) // self.batch_size)
+            if per_batch:
+                self._update_schedules(self.schedule_epoch, min(count / batches, 1.0))
+
+        # Memory-mapped files are shuffled locally in chunks, so reads from disk stay sequential.
+        chunk = None
+        if isinstance(X, numpy.memmap) and shuffle == 'full':
+            shuffle, chunk = 'chunk', self._chunk_size(X, batch_size)
+
+        # Batches may be views of the input data, so copy them if callbacks could mutate them.
+        on_start, on_finish = self._has_callback('on_batch_start'), self._has_callback('on_batch_finish')
+        copy = on_start or on_finish
+        ring = self.prefetch + 2 if self.prefetch else 1
+
+        # Training batches are augmented by the worker processes started for the whole training
+        # on these inputs, or otherwise in this process, e.g. for chunks of a stream.
+        augment = self.augment if mode == 'train' else None
+        pool = self.augment_pool[1] if augment is not None and self.augment_pool[0] is X else None
+
+        if self.device_resident:
+            self._load_device_data(processor, [X, y, w] if mode == 'train' else [X, y])
+            excerpts = self._iterate_excerpts(batch_size, X.shape[0], shuffle, indices, chunk)
+            iterator = ((None, None, None, e) for e in itertools.islice(excerpts, skip, None))
+        else:
+            iterator = self._iterate_data(batch_size, X, y, w, shuffle, copy=copy, ring=ring,
+                                          indices=indices, chunk=chunk, pool=pool, skip=skip)
+        if augment is not None and pool is None:
+            dtype = self.input_dtype
+            iterator = ((numpy.asarray(augment(Xb), dtype=dtype), yb, wb, e) for Xb, yb, wb, e in iterator)
+        if self.prefetch:
+            iterator = BatchPrefetcher(iterator, self.prefetch)
+
+        loop_start = time.time()
+        try:
+            for batch, (Xb, yb, wb, excerpt) in enumerate(iterator):
+                if deadline is not None and batch > 0:
+                    # Stop before a batch that would end after the deadline, on average.
+                    now = time.time()
+                    if now + (now - loop_start) / batch > deadline:
+                        self.timed_out = True
+                        break
+                if on_start:
+                    self._do_callback('on_batch_start', self._batch_variables(
+                                      X, y, w, Xb, yb, wb, excerpt, mode, batch))
+                if on_finish:
+                    start_time = time.time()
+
+                if self.device_resident:
+                    indices = numpy.arange(excerpt.start, excerpt.stop) if isinstance(excerpt, slice) else excerpt
+                    args = (indices,)
+                elif mode == 'train':
+                    args = (Xb, yb, wb if wb is not None else 1.0)
+                else:
+                    args = (Xb, yb)
 
-            while count / batches > progress / 60:
-                self._print(output)
-                progress += 1
-
-            self._do_callback('on_batch_finish', locals())
+                self.loss_count += excerpt.stop - excerpt.start if isinstance(excerpt, slice) else len(excerpt)
+                if store_losses:
+                    # Store the loss of each example before the update, for the next epochs.
+                    self.loss_table[excerpt] = processor(*args)
+                    count += 1
+                else:
+                    count += self._process_batch(processor, args, steps)
+
+                if accumulate and count % accumulate == 0:
+                    self.apply_gradients()
+                if per_batch:
+                    self._update_schedules(self.schedule_epoch, min(count / batches, 1.0))
+                if mode == 'train':
+                    self.batch_position += 1
+                    if self.interrupted:
+                        # Stop as soon as possible, the trainer then stores a checkpoint.
+                        break
+
+                while count / batches > progress / 60:
+                    self._print(output)
+                    progress += 1
+
+                if on_finish:
+                    variables = self._batch_variables(X, y, w, Xb, yb, wb, excerpt, mode, batch)
+                    variables.update(running_loss=self._read_loss, batch_time=time.time() - start_time)
+                    self._do_callback('on_batch_finish', variables)
+        finally:
+            if self.prefetch:
+                iterator.close()
+                self.stall_time += iterator.stall_time
+
+        # Apply the gradients of the remaining batches, averaged over fewer samples, unless
+        # they are stored in a checkpoint to continue accumulating after termination.
+        if accumulate and count % accumulate != 0 and not self.interrupted:
+            self.apply_gradients()
 
         self._print('\r')
-        return loss / count
+        return self._read_loss()
 
-    def _train_impl(self, X, y, w=None):
-        return self._batch_impl(X, y, w, self.trainer, mode='train', output='.', shuffle=True)
+    def _split_indices(self, X, split):
+        # Splits only apply to the exact array they were created for, not to other datasets.
+        return split[1] if split is not None and split[0] is X else None
+
+    def _chunk_layout(self, X, w):
+        # Separate chunks of samples need the image layout and weights of a full dataset.
+        if self.is_convolution(input=True):
+            X = self._conv_transpose(X)
+        if w is None and self.data_mask.ndim > 0:
+            w = numpy.ones((X.shape[0],), dtype=theano.config.floatX)
+        return X, w
+
+    def _stream_impl(self, stream, impl, train=False):
+        """Process all the chunks in the stream, returning the average loss of all the
+        samples, or ``None`` if there were none.
+        """
+        for X, y, w in stream:
+            X, w = self._chunk_layout(X, w)
+            impl(X, y, w)
+            if train and (self.interrupted or self.timed_out):
+                break
+        return self._read_loss()
 
-    def _valid_impl(self, X, y, w=None):
-        return self._batch_impl(X, y, w, self.validator, mode='valid', output=' ', shuffle=False)
+    def _epoch_indices(self, X, indices):
+        """Select the samples for the next epoch if ``epoch_size`` is smaller than the training
+        set, as consecutive positions in a random permutation when shuffling individual samples,
+        or in the original order otherwise.  The positions rotate from one epoch to the next.
+        """
+        total = X.shape[0] if indices is None else len(indices)
+        if not self.epoch_size or self.epoch_size >= total:
+            return indices
+
+        permute = self.shuffle_mode not in (None, False, 'block')
+        if self.epoch_source is not X or self.epoch_offset >= total:
+            self.epoch_source, self.epoch_offset = X, 0
+            self.epoch_order = numpy.random.permutation(total) if permute else None
+
+        positions = (self.epoch_offset + numpy.arange(self.epoch_size)) % total
+        self.epoch_offset += self.epoch_size
+        if self.epoch_order is not None:
+            # Sorting keeps the reads local, the batches are shuffled within the subset anyway.
+            positions = numpy.sort(self.epoch_order[positions])
+        return positions if indices is None else indices[positions]
+
+    def _refresh_losses(self, X, y, positions):
+        """Evaluate the loss of every example in the training set without updating the
+        network, which initializes the table of losses or corrects any stale entries.
+        """
+        if self.loss_source is not X:
+            self.loss_source = X
+            self.loss_table = numpy.zeros((X.shape[0],), dtype=theano.config.floatX)
+        for Xb, yb, _, excerpt in self._iterate_data(self.batch_size, X, y, indices=positions):
+            self.loss_table[excerpt] = self.sample_losses(Xb, yb)
+
+    def _sample_indices(self, X, y, w, indices):
+        """Draw the samples of the next epoch with replacement according to the ``sampling``
+        strategy, from the specified subset of ``indices`` if any.  Returns the indices in
+        the order they should be batched, and the weights corrected for the sampling.
+        """
+        positions = indices if indices is not None else numpy.arange(y.shape[0])
+        total = self.epoch_size or len(positions)
+
+        if self.sampling == 'loss':
+            if self.loss_source is not X or self.loss_epochs % (self.sampling_refresh or sys.maxsize) == 0:
+                self._refresh_losses(X, y, positions)
+            self.loss_epochs += 1
+
+            # Examples that are already fit well are rarely selected, so rarely backpropagated.
+            priority = numpy.power(self.loss_table[positions] + 1E-8, 1.0 / self.sampling_temperature,
+                                   dtype=numpy.float64)
+            return positions[numpy.random.choice(len(positions), total, p=priority / priority.sum())], w
+
+        if self.sampling == 'balanced':
+            assert self.is_classifier, "Balanced sampling is only supported for classifiers."
+            if self.sampling_cache[0] is not y:
+                self.sampling_cache = (y, self._class_labels(y))
+            labels = self.sampling_cache[1][positions]
+            groups = [positions[labels == l] for l in numpy.unique(labels)]
+
+            # Every batch takes the same quota from each class, and the slots that remain when
+            # the batch size isn't a multiple of the number of classes go to random classes.
+            classes = len(groups)
+            sizes = numpy.diff(numpy.append(numpy.arange(0, total, self.batch_size), total))
+            ranks = numpy.argsort(numpy.argsort(numpy.random.random((len(sizes), classes)), axis=1), axis=1)
+            quotas = sizes[:, None] // classes + (ranks < (sizes % classes)[:, None])
+
+            # Label each slot of the batches with its class, then draw the samples per class.
+            slots = numpy.repeat(numpy.tile(numpy.arange(classes), len(sizes)), quotas.ravel())
+            selected = numpy.empty((total,), dtype=positions.dtype)
+            for c, group in enumerate(groups):
+                mask = slots == c
+                selected[mask] = numpy.random.choice(group, numpy.count_nonzero(mask))
+            return selected, w
+
+        assert w is not None, "Weighted sampling requires the sample weights `w`."
+        weights = numpy.asarray(w[positions], dtype=numpy.float64)
+        selected = positions[numpy.random.choice(len(positions), total, p=weights / weights.sum())]
+        if self.sampling_cache[0] is not w:
+            # The importance correction of `p=w/sum(w)` is the same factor for all samples.
+            correct = numpy.full(w.shape, weights.mean(), dtype=theano.config.floatX)
+            self.sampling_cache = (w, correct)
+        return selected, self.sampling_cache[1]
+
+    def _train_impl(self, X, y, w=None):
+        # The loss covers all the samples of the epoch, including those processed before it
+        # was interrupted if it's resumed from a checkpoint.
+        self._reset_loss()
+        self.batch_position = 0
+        if self.resume_position is not None:
+            loss, self.loss_count = self.resume_position['loss']
+            self.loss_accumulator.set_value(numpy.asarray(loss, dtype=numpy.float64))
+            self.skip_batches, self.resume_position = self.resume_position['batches'], None
+
+        try:
+            if isinstance(X, ChunkStream):
+                return self._stream_impl(X, self._train_epoch, train=True)
+            return self._train_epoch(X, y, w)
+        finally:
+            self.skip_batches = 0
+
+    def _train_epoch(self, X, y, w):
+        indices, shuffle = self._split_indices(X, self.train_split), self.shuffle_mode
+        if self.sampling is not None:
+            # Batches keep their sampled content, only their order is shuffled.
+            (indices, w), shuffle = self._sample_indices(X, y, w, indices), 'block'
+        else:
+            indices = self._epoch_indices(X, indices)
+        return self._batch_impl(X, y, w, self.trainer, mode='train', output='.',
+                                shuffle=shuffle, indices=indices, store_losses=self.sampling == 'loss')
+
+    def _pass_impl(self, X, y, w=None):
+        """Train on each of the given samples exactly once, in the order of ``shuffle_mode``.
+        Unlike ``_train_impl()`` the ``sampling`` and ``epoch_size`` are not applied, since
+        they select the samples of epochs over a full dataset.
+        """
+        X, w = self._chunk_layout(X, w)
+        self._reset_loss()
+        return self._batch_impl(X, y, w, self.trainer, mode='train', output='.',
+                                shuffle=self.shuffle_mode)
+
+    def _valid_indices(self, X, indices):
+        """Select a fixed random subset of ``valid_samples`` from the validation set, which
+        is the same for every epoch so the estimated errors are comparable.
+        """
+        total = X.shape[0] if indices is None else len(indices)
+        if self.valid_samples >= total:
+            return indices
+
+        if self.valid_subset[0] is not X:
+            rng = numpy.random.RandomState(self.random_state)
+            positions = numpy.sort(rng.choice(total, self.valid_samples, replace=False))
+            self.valid_subset = (X, positions if indices is None else indices[positions])
+        return self.valid_subset[1]
+
+    def _valid_impl(self, X, y, w=None, subset=False):
+        self._reset_loss()
+        if isinstance(X, ChunkStream):
+            return self._stream_impl(X, self._valid_batches)
+        return self._valid_batches(X, y, w, subset)
+
+    def _valid_batches(self, X, y, w, subset=False):
+        indices = self._split_indices(X, self.valid_split)
+        if subset:
+            indices = self._valid_indices(X, indices)
+        return self._batch_impl(X, y, w, self.validator, mode='valid', output=' ',
+                                shuffle=False, indices=indices)
 
     @property
     def is_initialized(self):
@@ -382,3 +1076,107 @@ class MultiLayerPerceptronBackend(BaseBackend):
                 ps = tuple(p.shape.eval())
                 assert ps == d.shape, "Layer parameter shape mismatch: %r != %r" % (ps, d.shape)
                 p.set_value(d.astype(theano.config.floatX))
+
+    def _snapshot_params(self):
+        """Store a copy of all the parameters of the network, e.g. from the best epoch so far,
+        either on the device, on the host, or on disk as specified by ``snapshot_mode``.
+        """
+        params = [p for l in self.mlp for p in self._mlp_get_layer_params(l)]
+        if self.snapshot_mode == 'device':
+            if self.snapshot is None:
+                # The copies are updated by compiled functions, so no data goes through the host.
+                copies = [theano.shared(p.get_value(), broadcastable=p.broadcastable) for p in params]
+                self.snapshot = (theano.function([], [], updates=list(zip(copies, params))),
+                                 theano.function([], [], updates=list(zip(params, copies))),
+                                 copies)
+            self.snapshot[0]()
+        elif self.snapshot_mode == 'disk':
+            if self.snapshot is None:
+                self.snapshot = tempfile.mkdtemp(prefix='sknn-')
+                _snapshot_dirs.add(self.snapshot)
+            for i, p in enumerate(params):
+                numpy.save(os.path.join(self.snapshot, '%04i.npy' % i), p.get_value(borrow=True))
+        else:
+            self.snapshot = [p.get_value() for p in params]
+
+    def _snapshot_arrays(self):
+        """Read the parameters of the last snapshot stored, without changing the network.
+        """
+        if self.snapshot_mode == 'device':
+            return [c.get_value() for c in self.snapshot[2]]
+        if self.snapshot_mode == 'disk':
+            count = sum(len(self._mlp_get_layer_params(l)) for l in self.mlp)
+            return [numpy.load(os.path.join(self.snapshot, '%04i.npy' % i)) for i in range(count)]
+        return list(self.snapshot)
+
+    def _checkpoint_state(self):
+        """Collect the state of the trainer required to continue training exactly where it
+        stopped: the parameters, all variables of the learning rule such as the momentum or
+        the moment estimates of Adam, the best parameters so far and the order of samples.
+        """
+        return {'params': self._mlp_to_array(),
+                'updates': [v.get_value() for v in self._learning_rule.keys()],
+                'shared': [self.rate_shared.get_value(), self.momentum_shared.get_value()],
+                'best': self._snapshot_arrays() if self.snapshot is not None else None,
+                'splits': [s[1] if s is not None else None for s in (self.train_split, self.valid_split)],
+                'epochs': (self.epoch_order, self.epoch_offset)}
+
+    def _checkpoint_position(self):
+        """Collect the position of training within an interrupted epoch: the number of groups
+        of batches processed, their loss, and any gradients accumulated but not yet applied.
+        """
+        gradients = None
+        if self.accumulate_steps:
+            gradients = [b.get_value() for b in self.grad_buffers + [self.grad_count]]
+        return {'batches': self.batch_position,
+                'loss': (float(self.loss_accumulator.get_value()), self.loss_count),
+                'gradients': gradients}
+
+    def _restore_checkpoint(self, state, X, position=None):
+        """Set the state of the trainer from a checkpoint of the same network, for the
+        training data ``X`` which must be the same as when the checkpoint was stored.  If
+        the ``position`` within an epoch is specified, the next epoch continues from there.
+        """
+        assert len(state['updates']) == len(self._learning_rule),\
+            "The checkpoint was stored with a different network or `learning_rule`."
+
+        if state['best'] is not None:
+            params = [p for l in self.mlp for p in self._mlp_get_layer_params(l)]
+            for p, value in zip(params, state['best']):
+                p.set_value(value)
+            self._snapshot_params()
+        self._array_to_mlp(state['params'], self.mlp)
+        for v, value in zip(list(self._learning_rule.keys()) + [self.rate_shared, self.momentum_shared],
+                            state['updates'] + state['shared']):
+            v.set_value(value)
+
+        for name, indices in zip(('train_split', 'valid_split'), state['splits']):
+            split = getattr(self, name)
+            if split is not None and indices is not None:
+                setattr(self, name, (split[0], indices))
+        self.epoch_source = X
+        self.epoch_order, self.epoch_offset = state['epochs']
+
+        self.resume_position = position
+        if position is not None and position['gradients'] is not None:
+            for b, value in zip(self.grad_buffers + [self.grad_count], position['gradients']):
+                b.set_value(value)
+
+    def _restore_snapshot(self):
+        """Set the parameters of the network in place from the last snapshot stored, then
+        release the snapshot unless it's kept on the device for later training.
+        """
+        params = [p for l in self.mlp for p in self._mlp_get_layer_params(l)]
+        if self.snapshot_mode == 'device':
+            self.snapshot[1]()
+            return
+
+        if self.snapshot_mode == 'disk':
+            for i, p in enumerate(params):
+                p.set_value(numpy.load(os.path.join(self.snapshot, '%04i.npy' % i)), borrow=True)
+            shutil.rmtree(self.snapshot, ignore_errors=True)
+            _snapshot_dirs.discard(self.snapshot)
+        else:
+            for p, value in zip(params, self.snapshot):
+                p.set_value(value, borrow=True)
+        self.snapshot = None
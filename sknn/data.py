@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, unicode_literals, print_function)
+
+__all__ = ['BatchPrefetcher', 'ChunkStream', 'AugmentationPool', 'SlidingWindows']
+
+import sys
+import time
+import itertools
+import threading
+import collections
+import multiprocessing
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+
+class BatchPrefetcher(object):
+    """Wraps an iterator of batches and evaluates it ahead of time in a background thread,
+    storing up to ``size`` prepared batches in a bounded queue.  This allows slicing, type
+    conversion or densifying of batches to overlap with the training of the current batch.
+
+    The iterator must not recycle the memory of a batch until at least ``size + 2`` more
+    batches have been generated, as one may be in use and another being prepared.
+
+    Parameters
+    ----------
+
+    iterator: iterable
+        The source of batches, typically the generator from ``_iterate_data()``.
+
+    size: int
+        Maximum number of batches prepared in advance and waiting in the queue.
+    """
+
+    _FINISHED = object()
+
+    def __init__(self, iterator, size):
+        assert size > 0, "Prefetching requires a positive number of batches."
+
+        self.stall_time = 0.0
+        self._error = None
+        self._queue = queue.Queue(maxsize=size)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce, args=(iterator,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        # Wake up regularly to check if the consumer has closed this prefetcher early.
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, iterator):
+        try:
+            for item in iterator:
+                if not self._put(item):
+                    return
+        except Exception:
+            self._error = sys.exc_info()[1]
+        self._put(self._FINISHED)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.time()
+        item = self._queue.get()
+        self.stall_time += time.time() - start
+
+        if item is self._FINISHED:
+            self.close()
+            if self._error is not None:
+                raise self._error
+            raise StopIteration
+        return item
+
+    next = __next__
+
+    def close(self):
+        """Stop the background thread, for example if the consumer stops iterating early.
+        """
+        self._stop.set()
+        self._thread.join()
+
+
+class ChunkStream(object):
+    """Re-iterable source of data chunks, where each full iteration defines one epoch of
+    training.  The chunks are ``(X, y)`` or ``(X, y, w)`` tuples of arrays, and each of them
+    is passed through the ``transform`` function before it's returned.
+
+    Parameters
+    ----------
+
+    source: callable or iterable
+        Either a function returning a new iterator over the chunks for each epoch, or an
+        iterable such as a list of tuples.  Generators can only be iterated over once.
+
+    transform: callable, optional
+        Function called as ``transform(X, y, w)`` to prepare each chunk for training.
+    """
+
+    def __init__(self, source, transform=None):
+        self.source = source
+        self.transform = transform
+        self._pending = None
+        self._iterations = 0
+
+    def _open(self):
+        if callable(self.source):
+            return iter(self.source())
+
+        iterator = iter(self.source)
+        if iterator is self.source and self._iterations > 0:
+            raise ValueError("A single-pass iterator can only be used for one epoch; "
+                             "specify a function that returns a new iterator instead.")
+        self._iterations += 1
+        return iterator
+
+    def _prepare(self, chunk):
+        X, y, w = tuple(chunk) + (None,) * (3 - len(chunk))
+        return self.transform(X, y, w) if self.transform else (X, y, w)
+
+    def peek(self):
+        """Return the first chunk, which will still be included in the next iteration.
+        """
+        if self._pending is None:
+            iterator = self._open()
+            self._pending = (self._prepare(next(iterator)), iterator)
+        return self._pending[0]
+
+    def __iter__(self):
+        if self._pending is not None:
+            first, iterator = self._pending
+            self._pending = None
+            yield first
+        else:
+            iterator = self._open()
+
+        for chunk in iterator:
+            yield self._prepare(chunk)
+
+
+def _augment_worker(X, function, slots, shape, dtype, tasks, results):
+    views = [numpy.frombuffer(s, dtype=dtype).reshape(shape) for s in slots]
+    while True:
+        item = tasks.get()
+        if item is None:
+            return
+
+        task, slot, seed, excerpt = item
+        try:
+            numpy.random.seed(seed)
+            batch = function(numpy.asarray(X[excerpt], dtype=dtype))
+            views[slot][:batch.shape[0]] = batch
+            results.put((task, batch.shape[0], None))
+        except Exception as e:
+            results.put((task, 0, e))
+
+
+class AugmentationPool(object):
+    """Pool of worker processes that apply a data augmentation function to batches of the
+    input, writing the results into a ring of shared memory buffers read by the trainer.
+    The workers are forked, so they access the input data without copying it, and they
+    are reused by every call to ``iterate()`` until the pool is closed.
+
+    The global ``numpy.random`` generator is seeded deterministically for each batch before
+    the function is called, regardless of which worker processes the batch.
+
+    Parameters
+    ----------
+
+    X: numpy.ndarray
+        The input data, from which the samples of each batch are selected.
+
+    function: callable
+        Pure function that receives one batch of samples as an array, and returns the
+        augmented samples as an array of the same shape.
+
+    batch_size: int
+        Maximum number of samples in each batch.
+
+    dtype: numpy.dtype
+        Type of the augmented batches stored in the shared buffers, typically floatX.
+
+    workers: int
+        Number of worker processes to start.
+
+    ring: int, optional
+        Number of batches that must remain valid after they have been yielded, e.g.
+        when batches are prefetched.  Default is ``1``.
+    """
+
+    def __init__(self, X, function, batch_size, dtype, workers, ring=1):
+        assert isinstance(X, numpy.ndarray),\
+            "Augmentation workers require the input data as a dense numpy array."
+
+        self.dtype = numpy.dtype(dtype)
+        self.shape = (batch_size,) + X.shape[1:]
+        self.ring = ring
+        self.batches, self.stall_time = 0, 0.0
+        self._outstanding = 0
+
+        context = multiprocessing.get_context('fork')\
+                  if hasattr(multiprocessing, 'get_context') else multiprocessing
+        size = self.dtype.itemsize * int(numpy.prod(self.shape))
+        self.slots = [context.RawArray('b', size) for _ in range(ring + workers)]
+        self.views = [numpy.frombuffer(s, dtype=self.dtype).reshape(self.shape) for s in self.slots]
+
+        self.tasks, self.results = context.Queue(), context.Queue()
+        self.workers = [context.Process(target=_augment_worker,
+                                        args=(X, function, self.slots, self.shape, self.dtype,
+                                              self.tasks, self.results))
+                        for _ in range(workers)]
+        for p in self.workers:
+            p.daemon = True
+            p.start()
+        self.start_time = time.time()
+
+    def iterate(self, excerpts):
+        """Generate ``(Xb, excerpt)`` pairs of augmented batches for each of the excerpts,
+        in the same order.  Each batch stays valid until ``ring`` more batches are yielded.
+        """
+        # Tasks of a previous iteration that stopped early must not be mistaken for new ones.
+        while self._outstanding > 0:
+            self._result()
+
+        excerpts = iter(excerpts)
+        free = list(range(len(self.slots)))
+        pending, in_use, finished = collections.deque(), collections.deque(), {}
+
+        for task in itertools.count():
+            # Keep all the slots that are not used by the consumer busy with new batches.
+            while free:
+                excerpt = next(excerpts, None)
+                if excerpt is None:
+                    break
+                slot, seed = free.pop(), numpy.random.randint(2**31)
+                self.tasks.put((task + len(pending), slot, seed, excerpt))
+                pending.append((slot, excerpt))
+                self._outstanding += 1
+            if not pending:
+                return
+
+            start = time.time()
+            while task not in finished:
+                index, count, error = self._result()
+                if error is not None:
+                    raise error
+                finished[index] = count
+            self.stall_time += time.time() - start
+
+            slot, excerpt = pending.popleft()
+            in_use.append(slot)
+            self.batches += 1
+            yield self.views[slot][:finished.pop(task)], excerpt
+
+            if len(in_use) >= self.ring:
+                free.append(in_use.popleft())
+
+    def _result(self):
+        # Workers that die, e.g. when killed for lack of memory, never report, so check on them.
+        while True:
+            try:
+                result = self.results.get(timeout=1.0)
+                self._outstanding -= 1
+                return result
+            except queue.Empty:
+                dead = [p for p in self.workers if not p.is_alive()]
+                if dead:
+                    raise RuntimeError("Augmentation worker exited unexpectedly with code %s." % dead[0].exitcode)
+
+    def close(self):
+        """Stop all the worker processes and release the queues.
+        """
+        for _ in self.workers:
+            self.tasks.put(None)
+        try:
+            # Workers can only exit once the results they stored have been read.
+            while self._outstanding > 0:
+                self._result()
+        except RuntimeError:
+            pass
+
+        for p in self.workers:
+            p.join(timeout=10.0)
+            if p.is_alive():
+                p.terminate()
+                p.join()
+        for q in (self.tasks, self.results):
+            q.close()
+            q.join_thread()
+
+
+class SlidingWindows(object):
+    """Adapter for time series that presents all the sliding windows over a series as the
+    rows of an input matrix, along with the value that follows each window as the target.
+    Both are read-only strided views of the series, so memory stays proportional to the
+    length of the series rather than the number of windows times their length.  Batches
+    of windows are only expanded when they are gathered for training or prediction.
+
+    Pass an instance of this class as ``X`` to ``fit()`` or ``predict()`` of a regressor,
+    without specifying ``y``.
+
+    Parameters
+    ----------
+
+    series: numpy.ndarray
+        Array of shape ``(n_steps,)`` or ``(n_steps, n_features)`` storing the values of
+        the series, which is copied only if it's not C-contiguous.
+
+    window: int
+        Number of consecutive steps in each window, so the inputs have ``window * n_features``
+        columns, with the features of each step stored contiguously.
+
+    stride: int, optional
+        Number of steps between the start of two consecutive windows.  Default is ``1``.
+
+    horizon: int, optional
+        How many steps after the end of its window the target of each window is taken.
+        Default is ``1``, which uses the step immediately following the window.  Specify
+        ``None`` for prediction only, which then includes all the windows in the series.
+    """
+
+    def __init__(self, series, window, stride=1, horizon=1):
+        assert window >= 1 and stride >= 1,\
+            "Sliding windows require a positive `window` size and `stride`."
+        assert horizon is None or horizon >= 1,\
+            "The target `horizon` must be at least one step after the window."
+
+        self.series = numpy.ascontiguousarray(series)
+        self.window, self.stride, self.horizon = window, stride, horizon
+
+        steps, features = self.series.shape[0], int(numpy.prod(self.series.shape[1:]))
+        count = (steps - window - (horizon or 0)) // stride + 1
+        assert count > 0, "The series with %i steps is too short for a single window." % steps
+
+        step = self.series.strides[0]
+        self.X = as_strided(self.series, shape=(count, window * features),
+                            strides=(stride * step, self.series.itemsize))
+        self.y = None
+        if horizon is not None:
+            target = self.series[window + horizon - 1:]
+            self.y = as_strided(target, shape=(count,) + target.shape[1:],
+                                strides=(stride * step,) + target.strides[1:])
+
+        # Windows overlap in memory, so any write would affect multiple samples.
+        for array in (self.X, self.y):
+            if array is not None:
+                array.flags.writeable = False
+
+    def __len__(self):
+        return self.X.shape[0]
@@ -7,9 +7,18 @@ import os
 import sys
 import math
 import time
+import types
+import pickle
+import signal
 import logging
 import itertools
 import contextlib
+import collections
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 log = logging.getLogger('sknn')
 
@@ -22,15 +31,39 @@ import sklearn.preprocessing
 import sklearn.cross_validation
 
 from .nn import NeuralNetwork, Layer, Convolution, Native, ansi
+from .data import ChunkStream, SlidingWindows
 from . import backend
 
 
+def _downcast_inplace(array, dtype, chunk=2**20):
+    """Convert a C-contiguous array to a type of the same or smaller size within its own
+    memory, one chunk at a time, and return the converted view.  Each chunk is read before
+    it's overwritten, since the converted values never extend past the original ones.
+    The original array is no longer valid afterwards.
+    """
+    source = array.reshape(-1)
+    target = source.view(numpy.uint8)[:source.size * dtype.itemsize].view(dtype)
+    for s in range(0, source.size, chunk):
+        numpy.copyto(target[s:s+chunk], source[s:s+chunk].copy(), casting='unsafe')
+    return target.reshape(array.shape)
+
+
+def _is_window_view(array):
+    # Views whose rows overlap in memory, e.g. sliding windows, would be expanded by a copy.
+    if not isinstance(array, numpy.ndarray) or array.flags.owndata:
+        return False
+    span = sum((n - 1) * abs(s) for n, s in zip(array.shape, array.strides)) + array.itemsize
+    return array.size > 0 and array.nbytes > span
+
+
 class MultiLayerPerceptron(NeuralNetwork, sklearn.base.BaseEstimator):
     # Abstract base class for wrapping multi-layer perceptron functionality.
     __doc__ = NeuralNetwork.__doc__
 
     def _setup(self):
-        pass
+        self.feature_names = None
+        self.copied_bytes = collections.Counter()
+        self._subscribe()
 
     def _initialize(self, X, y=None, w=None):
         assert not self.is_initialized,\
@@ -108,6 +141,82 @@ class MultiLayerPerceptron(NeuralNetwork, sklearn.base.BaseEstimator):
         # may have been serialized for multiprocessing reasons pre-training.
         self._create_logger()
         self._backend = None
+        self._subscribe()
+
+    def _expand_windows(self, X, y=None):
+        # Sliding windows over a time series provide both the inputs and the targets as views.
+        if isinstance(X, SlidingWindows):
+            return X.X, (X.y if y is None else y)
+        return X, y
+
+    def _count_copy(self, phase, source, result):
+        # Account for the memory of arrays that were duplicated, rather than viewed or reused.
+        if result is source or not hasattr(result, 'nbytes'):
+            return
+        if isinstance(source, numpy.ndarray) and numpy.may_share_memory(source, result):
+            return
+        self.copied_bytes[phase] += result.nbytes
+
+    def _convert_dtypes(self, X, y=None, w=None, phase='convert'):
+        """Apply the ``dtype_policy`` to the dense arrays before training or predicting,
+        converting them up front to ``theano.config.floatX`` or rejecting other types.
+        Copies are accounted for in the specified ``phase``.
+        """
+        dtype = numpy.dtype(theano.config.floatX)
+        if self.dtype_policy == 'auto':
+            return X, y, w
+
+        def convert(array, name, compact=()):
+            if not hasattr(array, 'dtype') or array.dtype == dtype or array.dtype.name in compact:
+                return array
+            if self.dtype_policy == 'strict':
+                raise ValueError("Expecting `%s` of type `%s` with the strict `dtype_policy`, not `%s`."
+                                 % (name, dtype, array.dtype))
+            if isinstance(array, numpy.memmap) or _is_window_view(array):
+                # Converting would load the whole file or expand overlapping windows, e.g. of
+                # `SlidingWindows`, so their batches are converted instead.
+                return array
+            if self.dtype_policy == 'convert_inplace' and isinstance(array, numpy.ndarray)\
+               and array.flags.c_contiguous and array.flags.writeable\
+               and array.dtype.itemsize >= dtype.itemsize:
+                return _downcast_inplace(array, dtype)
+
+            result = array.astype(dtype)
+            self._count_copy(phase, array, result)
+            return result
+
+        return convert(X, 'X', ('uint8', 'uint16')), convert(y, 'y'), convert(w, 'w')
+
+    def _memory_map(self, *arrays):
+        # Filenames of `.npy` arrays are opened as memory maps, so they are never fully loaded.
+        string_types = getattr(types, 'StringTypes', tuple([str]))
+        return [numpy.load(a, mmap_mode='r') if isinstance(a, string_types) else a for a in arrays]
+
+    def _convert_frames(self, X, y=None, w=None, fit=False, phase='frames'):
+        # Convert pandas objects into arrays once, rather than indexing them for each batch.
+        # Their types are then handled by the `dtype_policy` like those of any other array.
+        if type(X).__name__ == 'DataFrame':
+            columns = list(X.columns)
+            known = getattr(self, 'feature_names', None)
+            if fit:
+                self.feature_names = columns
+            elif known is not None and columns != known:
+                missing = [c for c in known if c not in columns]
+                if missing:
+                    raise ValueError("Input DataFrame is missing columns: %s." % ', '.join(map(str, missing)))
+                log.warning("  - Reordering DataFrame columns to match those used for fitting.")
+                X = X[known]
+            # Homogeneous frames provide a view of their data, but mixed types are combined.
+            mixed = len(set(X.dtypes)) > 1
+            X = X.values
+            if mixed:
+                self.copied_bytes[phase] += X.nbytes
+
+        if type(y).__name__ in ('DataFrame', 'Series'):
+            y = y.values
+        if type(w).__name__ == 'Series':
+            w = w.values
+        return X, y, w
 
     def _reshape(self, X, y=None):
         if y is not None and y.ndim == 1:
@@ -123,101 +232,298 @@ class MultiLayerPerceptron(NeuralNetwork, sklearn.base.BaseEstimator):
             X = X.reshape((X.shape[0], numpy.product(X.shape[1:])))
         return X, y
 
-    def _do_callback(self, event, variables):
+    def _subscribe(self):
+        # Precompute the events with subscribers, so the others cost nothing while training.
         if self.callback is None:
-            return
+            self._subscribed = frozenset()
+        elif isinstance(self.callback, dict):
+            self._subscribed = frozenset(self.callback)
+        else:
+            self._subscribed = frozenset(['on_train_start', 'on_epoch_start', 'on_batch_start',
+                                          'on_batch_finish', 'on_epoch_finish', 'on_train_finish'])
+
+    def _has_callback(self, event):
+        return event in self._subscribed
+
+    def _do_callback(self, event, variables):
+        if event not in self._subscribed:
+            return True
 
-        del variables['self']
         if isinstance(self.callback, dict):
-            function = self.callback.get(event, None)
-            return function(**variables) if function else True
+            return self.callback[event](**variables)
         else:
             return self.callback(event, **variables)
 
-    def _train(self, X, y, w=None):
-        assert self.n_iter or self.n_stable,\
-            "Neither n_iter nor n_stable were specified; training would loop forever."
+    def _epoch_variables(self, variables):
+        # Documented statistics passed to the epoch and training callbacks, from the loop state.
+        names = ['X', 'y', 'w', 'i', 'avg_train_error', 'avg_valid_error', 'sample_valid_error',
+                 'best_train_error', 'best_valid_error', 'is_best_train', 'is_best_valid',
+                 'is_validated', 'best_epoch', 'n_stable', 'start_time', 'finish_time']
+        return {k: variables[k] for k in names if k in variables}
+
+    def _train(self, X, y, w=None, start=None):
+        assert self.n_iter or self.n_stable or self.max_time,\
+            "Neither n_iter, n_stable nor max_time were specified; training would loop forever."
 
         best_train_error, best_valid_error = float("inf"), float("inf")
-        best_params = [] 
+        best_sample_error = float("inf")
+        train_time, valid_time = 0.0, 0.0
+        best_epoch = None
         n_stable = 0
-        self._do_callback('on_train_start', locals())
-
-        for i in itertools.count(1):
-            start_time = time.time()
-            self._do_callback('on_epoch_start', locals())
-
-            is_best_train = False
-            avg_train_error = self._backend._train_impl(X, y, w)
-            if avg_train_error is not None:
-                if math.isnan(avg_train_error):
-                    raise RuntimeError("Training diverged and returned NaN.")
+        self._backend.stall_time = 0.0
+        self._backend.augment_stats.clear()
+        for schedule in (self.learning_schedule, self.momentum_schedule):
+            if schedule is not None:
+                schedule.reset()
+
+        start_epoch, checkpoint_time = 0, time.time()
+        epochs = itertools.count(1)
+        loop = self._load_checkpoint(X) if self.resume_from is not None else None
+        if loop is not None:
+            start_epoch, n_stable, best_epoch, best_train_error, best_valid_error,\
+                best_sample_error, train_time, valid_time = [loop[k] for k in self._checkpoint_variables]
+            epochs = itertools.count(start_epoch + 1)
+            if (self.n_iter is not None and start_epoch >= self.n_iter) or\
+               (self.n_stable is not None and n_stable >= self.n_stable):
+                log.info("Training had already finished in the checkpoint at %i iterations.", start_epoch)
+                epochs = []
+        self._subscribe()
+        self._do_callback('on_train_start', {'X': X, 'y': y, 'w': w})
+
+        # A subset only saves time if it's smaller than the validation set, which streams can't tell.
+        use_subset = bool(self.valid_samples) and self.valid_set is not None\
+                     and self.valid_samples < self._valid_count()
+
+        # The time budget applies to the whole call from its `start`, including the compilation
+        # of the network, while epochs are estimated from those of this training loop.
+        train_start = time.time()
+        start = start or train_start
+        self._backend.deadline = start + self.max_time if self.max_time else None
+        self._backend.timed_out = False
+
+        with self._handle_termination() as termination, self._backend._augmentation(X):
+            for i in epochs:
+                start_time = time.time()
+                completed = i - 1 - start_epoch
+                if self.max_time and completed > 0 and\
+                   start_time + (start_time - train_start) / completed > self._backend.deadline:
+                    log.debug("")
+                    log.info("Stopping after %i iterations, since another would exceed `max_time`.", i - 1)
+                    break
+
+                # An interrupted epoch continues from the same samples, so keep how it started.
+                if self.checkpoint_dir is not None:
+                    termination['state'] = (None, self._epoch_start_state(dict(locals(), i=i - 1)))
+
+                if self._has_callback('on_epoch_start'):
+                    self._do_callback('on_epoch_start', {'X': X, 'y': y, 'w': w, 'i': i, 'start_time': start_time})
+
+                is_best_train = False
+                self._backend._update_schedules(i - 1)
+                avg_train_error = self._backend._train_impl(X, y, w)
+                if self._backend.interrupted:
+                    break
+                if self._backend.timed_out:
+                    log.debug("")
+                    log.info("Stopping during iteration %i, since another batch would exceed `max_time`.", i)
+                    break
+                if avg_train_error is not None:
+                    if math.isnan(avg_train_error):
+                        raise RuntimeError("Training diverged and returned NaN.")
                 
-                best_train_error = min(best_train_error, avg_train_error)
-                is_best_train = bool(avg_train_error < best_train_error * (1.0 + self.f_stable))
-
-            is_best_valid = False
-            avg_valid_error = None
-            if self.valid_set is not None:
-                avg_valid_error = self._backend._valid_impl(*self.valid_set)
-                if avg_valid_error is not None:
-                    best_valid_error = min(best_valid_error, avg_valid_error)
-                    is_best_valid = bool(avg_valid_error < best_valid_error * (1.0 + self.f_stable))
-
-            finish_time = time.time()
-            log.debug("\r{:>5}         {}{}{}            {}{}{}        {:>5.1f}s".format(
-                      i,
-                      ansi.BLUE if is_best_train else "",
-                      "{0:>10.3e}".format(float(avg_train_error)) if (avg_train_error is not None) else "     N/A  ",
-                      ansi.ENDC if is_best_train else "",
-
-                      ansi.GREEN if is_best_valid else "",
-                      "{:>10.3e}".format(float(avg_valid_error)) if (avg_valid_error is not None) else "     N/A  ",
-                      ansi.ENDC if is_best_valid else "",
-
-                      finish_time - start_time
-                      ))
-
-            if is_best_valid or (self.valid_set is None and is_best_train):
-                best_params = self._backend._mlp_to_array()
-                n_stable = 0
-            else:
-                n_stable += 1
+                    best_train_error = min(best_train_error, avg_train_error)
+                    is_best_train = bool(avg_train_error < best_train_error * (1.0 + self.f_stable))
+
+                valid_start = time.time()
+                train_time += valid_start - start_time
+
+                is_best_valid, is_validated = False, False
+                avg_valid_error, sample_valid_error = None, None
+                if self.valid_set is not None and i % self.valid_every == 0\
+                   and (self.valid_budget is None or valid_time <= self.valid_budget * train_time):
+                    is_validated, is_full = True, True
+                    if use_subset:
+                        # Estimate the error on a subset, then confirm a suspected new best on the full set.
+                        sample_valid_error = self._backend._valid_impl(*self.valid_set, subset=True)
+                        is_full = sample_valid_error is not None and sample_valid_error < best_sample_error * (1.0 + self.f_stable)
+                        if sample_valid_error is not None:
+                            best_sample_error = min(best_sample_error, sample_valid_error)
+
+                    if is_full:
+                        avg_valid_error = self._backend._valid_impl(*self.valid_set)
+                        if avg_valid_error is not None:
+                            best_valid_error = min(best_valid_error, avg_valid_error)
+                            is_best_valid = bool(avg_valid_error < best_valid_error * (1.0 + self.f_stable))
+
+                # Schedules that react to plateaus always observe the same estimator of the error,
+                # i.e. the fixed subset if there's one, as the full set is only evaluated selectively.
+                observed = sample_valid_error if use_subset else avg_valid_error
+                if is_validated and observed is not None:
+                    self._backend._observe_schedules(observed)
+                elif self.valid_set is None and avg_train_error is not None:
+                    self._backend._observe_schedules(avg_train_error)
+
+                finish_time = time.time()
+                valid_time += finish_time - valid_start
+                log.debug("\r{:>5}         {}{}{}            {}{}{}        {:>5.1f}s".format(
+                          i,
+                          ansi.BLUE if is_best_train else "",
+                          "{0:>10.3e}".format(float(avg_train_error)) if (avg_train_error is not None) else "     N/A  ",
+                          ansi.ENDC if is_best_train else "",
+
+                          ansi.GREEN if is_best_valid else "",
+                          "{:>10.3e}".format(float(avg_valid_error)) if (avg_valid_error is not None) else "     N/A  ",
+                          ansi.ENDC if is_best_valid else "",
+
+                          finish_time - start_time
+                          ))
+
+                if is_best_valid or (self.valid_set is None and is_best_train):
+                    self._backend._snapshot_params()
+                    best_epoch = i
+                    n_stable = 0
+                elif self.valid_set is None or is_validated:
+                    n_stable += 1
+
+                if self.checkpoint_dir is not None:
+                    termination['state'] = (dict(locals()), None)
+                if (self.checkpoint_epochs and i % self.checkpoint_epochs == 0) or\
+                   (self.checkpoint_minutes and time.time() - checkpoint_time >= self.checkpoint_minutes * 60.0):
+                    self._save_checkpoint(self._checkpoint_state(locals()))
+                    checkpoint_time = time.time()
+
+                if self._has_callback('on_epoch_finish') and\
+                   self._do_callback('on_epoch_finish', self._epoch_variables(locals())) == False:
+                    log.debug("")
+                    log.info("User defined callback terminated at %i iterations.", i)
+                    break
+
+                if self.n_stable is not None and n_stable >= self.n_stable:
+                    log.debug("")
+                    log.info("Early termination condition fired at %i iterations.", i)
+                    break
+                if self.n_iter is not None and i >= self.n_iter:
+                    log.debug("")
+                    log.info("Terminating after specified %i total iterations.", i)
+                    break
+                if self._backend.interrupted:
+                    break
+
+        self._backend.deadline = None
+        if self._has_callback('on_train_finish'):
+            self._do_callback('on_train_finish', self._epoch_variables(locals()))
+        if best_epoch is not None:
+            self._backend._restore_snapshot()
+
+        if self.prefetch:
+            log.debug("  - Waited {:.2f}s in total for batches to be prefetched.".format(self._backend.stall_time))
+        stats = self._backend.augment_stats
+        if stats['batches'] > 0:
+            log.debug("  - Augmented {:,} batches at {:,.1f} per second, waited {:.2f}s in total for them.".format(
+                      int(stats['batches']), stats['batches'] / max(stats['time'], 1E-9), stats['stall']))
+
+    def _valid_count(self):
+        X_v = self.valid_set[0]
+        indices = self._backend._split_indices(X_v, self._backend.valid_split)
+        if indices is not None:
+            return len(indices)
+        return X_v.shape[0] if hasattr(X_v, 'shape') else 0
+
+    _checkpoint_variables = ('i', 'n_stable', 'best_epoch', 'best_train_error', 'best_valid_error',
+                             'best_sample_error', 'train_time', 'valid_time')
+
+    def _epoch_start_state(self, variables):
+        """Collect the small part of the state that changes when an epoch starts, i.e. the
+        variables of the training loop, the schedules and the selection of samples.
+        """
+        return {'loop': {k: variables[k] for k in self._checkpoint_variables},
+                'schedules': [s.__dict__.copy() if s is not None else None
+                              for s in (self.learning_schedule, self.momentum_schedule)],
+                'random': numpy.random.get_state(),
+                'epochs': (self._backend.epoch_order, self._backend.epoch_offset)}
+
+    def _checkpoint_state(self, variables, start=None):
+        """Collect the full state of training as copies that are not affected by further
+        training, either after an epoch with the given variables of the training loop, or
+        at the current position within an epoch from the state when it ``start``-ed.
+        """
+        state = dict(start or self._epoch_start_state(variables))
+        epochs = state.pop('epochs')
+        state['backend'] = self._backend._checkpoint_state()
+        if start is not None:
+            state['backend']['epochs'] = epochs
+            state['position'] = self._backend._checkpoint_position()
+        return state
+
+    def _save_checkpoint(self, state):
+        """Store the state of training in ``checkpoint_dir``, replacing the previous
+        checkpoint only once the new one has been written entirely.
+        """
+        if not os.path.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+        filename = os.path.join(self.checkpoint_dir, 'checkpoint.pkl')
+        with open(filename + '.tmp', 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        getattr(os, 'replace', os.rename)(filename + '.tmp', filename)
+
+    def _load_checkpoint(self, X):
+        """Restore the state of training from ``resume_from`` if a checkpoint exists, and
+        return the variables of the training loop, or ``None`` otherwise.
+        """
+        filename = self.resume_from
+        if os.path.isdir(filename):
+            filename = os.path.join(filename, 'checkpoint.pkl')
+        if not os.path.isfile(filename):
+            log.info("No checkpoint found in `%s`, training from the start.", self.resume_from)
+            return None
+
+        with open(filename, 'rb') as f:
+            state = pickle.load(f)
+        self._backend._restore_checkpoint(state['backend'], X, state.get('position'))
+        for schedule, values in zip((self.learning_schedule, self.momentum_schedule), state['schedules']):
+            if schedule is not None and values is not None:
+                schedule.__dict__.update(values)
+        numpy.random.set_state(state['random'])
+
+        if state.get('position') is not None:
+            log.info("Resuming training from a checkpoint after %i iterations and %i batches.",
+                     state['loop']['i'], state['position']['batches'])
+        else:
+            log.info("Resuming training from a checkpoint after %i iterations.", state['loop']['i'])
+        return state['loop']
 
-            if self._do_callback('on_epoch_finish', locals()) == False:
-                log.debug("")
-                log.info("User defined callback terminated at %i iterations.", i)
-                break
+    @contextlib.contextmanager
+    def _handle_termination(self):
+        # When storing checkpoints, SIGTERM stops training after the current batch, then the
+        # most recent state the training loop recorded in the yielded dictionary is stored
+        # and the signal is delivered again to the original handler.
+        self._backend.interrupted = False
+        termination = {}
+        previous = None
+        if self.checkpoint_dir is not None:
+            def interrupt(signum, frame):
+                self._backend.interrupted = True
+            try:
+                previous = signal.signal(signal.SIGTERM, interrupt)
+            except ValueError:
+                log.warning("Checkpoints on SIGTERM are only stored when training in the main thread.")
 
-            if self.n_stable is not None and n_stable >= self.n_stable:
-                log.debug("")
-                log.info("Early termination condition fired at %i iterations.", i)
-                break
-            if self.n_iter is not None and i >= self.n_iter:
+        try:
+            yield termination
+        finally:
+            if previous is not None:
+                signal.signal(signal.SIGTERM, previous)
+        if self._backend.interrupted and previous is not None:
+            if 'state' in termination:
+                variables, start = termination['state']
+                state = self._checkpoint_state(variables, start)
+                self._save_checkpoint(state)
                 log.debug("")
-                log.info("Terminating after specified %i total iterations.", i)
-                break
+                log.info("Stored a checkpoint after termination signal at %i iterations%s.", state['loop']['i'],
+                         " and %i batches" % state['position']['batches'] if 'position' in state else "")
+            os.kill(os.getpid(), signal.SIGTERM)
 
-        self._do_callback('on_train_finish', locals())
-        self._backend._array_to_mlp(best_params, self._backend.mlp)
-
-    def _fit(self, X, y, w=None):
-        assert X.shape[0] == y.shape[0],\
-            "Expecting same number of input and output samples."
-        data_shape = X.shape
-        known_size = hasattr(X, 'size') and hasattr(y, 'size')
-        data_size = '{:,}'.format(X.size+y.size) if known_size else 'N/A'
-        X, y = self._reshape(X, y)
-
-        if not self.is_initialized:
-            X, y = self._initialize(X, y, w)
-
-        log.info("Training on dataset of {:,} samples with {} total size.".format(data_shape[0], data_size))
-        if data_shape[1:] != X.shape[1:]:
-            log.warning("  - Reshaping input array from {} to {}.".format(data_shape, X.shape))
-        if self.valid_set is not None:
-            X_v, _ = self.valid_set
-            log.debug("  - Train: {: <9,}  Valid: {: <4,}".format(X.shape[0], X_v.shape[0]))
+    def _log_settings(self):
         regularize = self.regularize or self.auto_enabled.get('regularize', None)
         if regularize is not None:
             comment = ", auto-enabled from layers" if 'regularize' in self.auto_enabled else "" 
@@ -226,8 +532,24 @@ class MultiLayerPerceptron(NeuralNetwork, sklearn.base.BaseEstimator):
         if normalize is not None:
             comment = ", auto-enabled from layers" if 'normalize' in self.auto_enabled else ""
             log.debug("  - Using `%s` normalization%s." % (normalize, comment))
+        for name, schedule in (('learning rate', self.learning_schedule), ('momentum', self.momentum_schedule)):
+            if schedule is not None:
+                log.debug("  - Scheduling the {} with {}.".format(name, schedule.__class__.__name__))
+        if self.checkpoint_dir is not None:
+            log.debug("  - Storing checkpoints in `{}`.".format(self.checkpoint_dir))
+        if self.epoch_size is not None:
+            log.debug("  - Using subsets of {:,} samples for each epoch.".format(self.epoch_size))
+        if self.sampling is not None:
+            log.debug("  - Drawing training samples with `{}` sampling.".format(self.sampling))
+        if self.valid_every > 1 or self.valid_samples or self.valid_budget:
+            log.debug("  - Validating every {} epochs{}{}.".format(
+                      self.valid_every,
+                      ", estimated on {:,} samples".format(self.valid_samples) if self.valid_samples else "",
+                      ", within {:.0%} of training time".format(self.valid_budget) if self.valid_budget else ""))
         if self.n_iter is not None:
             log.debug("  - Terminating loop after {} total iterations.".format(self.n_iter))
+        if self.max_time is not None:
+            log.debug("  - Terminating loop within {:,.1f}s of training.".format(self.max_time))
         if self.n_stable is not None and self.n_stable < (self.n_iter or sys.maxsize):
             log.debug("  - Early termination after {} stable iterations.".format(self.n_stable))
 
@@ -235,8 +557,73 @@ class MultiLayerPerceptron(NeuralNetwork, sklearn.base.BaseEstimator):
             log.debug("\nEpoch       Training Error       Validation Error       Time"
                       "\n------------------------------------------------------------")
 
+    def _prepare_chunk(self, X, y, w=None, fit=False, phase='convert'):
+        # Chunks of a stream and incremental samples are converted like a full dataset.
+        X, y = self._expand_windows(X, y)
+        X, y, w = self._convert_frames(X, y, w, fit=fit, phase=phase)
+        X, y, w = self._convert_dtypes(X, y, w, phase=phase)
+        assert X.shape[0] == y.shape[0],\
+            "Expecting same number of input and output samples."
+        X, y = self._reshape(X, y)
+        return X, y, w
+
+    def _fit_iter(self, chunks, valid_chunks=None):
+        start = time.time()
+        assert self.valid_size == 0.0,\
+            "Specify `valid_chunks` to validate while streaming, not `valid_size`."
+
+        stream = ChunkStream(chunks, self._prepare_chunk)
+        if not self.is_initialized:
+            self._initialize(*stream.peek())
+
+        log.info("Training on a stream of chunks, with one pass over all chunks per epoch.")
+        self._log_settings()
+
+        backup = self.valid_set
+        if valid_chunks is not None:
+            self.valid_set = (ChunkStream(valid_chunks, self._prepare_chunk), None)
+        elif self.valid_set is not None:
+            # The validation set is converted once like the chunks, including the labels.
+            self.valid_set = (ChunkStream([self._prepare_chunk(*self.valid_set, phase='valid')]), None)
+        try:
+            self._train(stream, None, start=start)
+        finally:
+            self.valid_set = backup
+        return self
+
+    def _fit(self, X, y, w=None):
+        start = time.time()
+        X, y = self._expand_windows(X, y)
+        X, y, w = self._memory_map(X, y, w)
+        X, y, w = self._convert_frames(X, y, w, fit=True)
+        X, y, w = self._convert_dtypes(X, y, w)
+        assert X.shape[0] == y.shape[0],\
+            "Expecting same number of input and output samples."
+        data_shape = X.shape
+        known_size = hasattr(X, 'size') and hasattr(y, 'size')
+        data_size = '{:,}'.format(X.size+y.size) if known_size else 'N/A'
+        X_r, y_r = self._reshape(X, y)
+        self._count_copy('reshape', X, X_r)
+        self._count_copy('reshape', y, y_r)
+        X, y = X_r, y_r
+
+        if not self.is_initialized:
+            X, y = self._initialize(X, y, w)
+
+        log.info("Training on dataset of {:,} samples with {} total size.".format(data_shape[0], data_size))
+        if data_shape[1:] != X.shape[1:]:
+            log.warning("  - Reshaping input array from {} to {}.".format(data_shape, X.shape))
+        if self.valid_set is not None:
+            X_v, _ = self.valid_set
+            train_idx = self._backend._split_indices(X, self._backend.train_split)
+            valid_idx = self._backend._split_indices(X_v, self._backend.valid_split)
+            log.debug("  - Train: {: <9,}  Valid: {: <4,}".format(
+                      X.shape[0] if train_idx is None else len(train_idx),
+                      X_v.shape[0] if valid_idx is None else len(valid_idx)))
+        self._log_settings()
+
         try:
-            self._train(X, y, w)
+            self._train(X, y, w, start=start)
         except RuntimeError as e:
             log.error("\n{}{}{}\n\n{}\n".format(
                 ansi.RED,
@@ -247,9 +634,49 @@ class MultiLayerPerceptron(NeuralNetwork, sklearn.base.BaseEstimator):
                 "    learning_rate=%f" % (self.learning_rate * 0.1)))
             raise e
 
+        if resource is not None:
+            # The peak covers the lifetime of the process, not only this call.  Mac OS X reports
+            # it in bytes, while Linux and the BSDs report it in kilobytes.
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            peak *= 1 if sys.platform == 'darwin' else 1024
+            log.debug("  - Peak resident memory of the process so far {:,.1f} MB.".format(peak / 2.0**20))
+        copies = ['{} {:,.1f} MB'.format(k, v / 2.0**20) for k, v in sorted(self.copied_bytes.items())]
+        log.debug("  - Data copied by phase: {}.".format(', '.join(copies) or 'none'))
         return self
 
+    def _partial_fit(self, X, y, w=None, valid_set=None):
+        """Train for exactly one pass over the given samples, initializing the network only
+        on the first call and reusing the compiled trainer afterwards.  The samples are then
+        validated on ``valid_set`` if specified.  Returns the average training and validation
+        errors.  The ``sampling`` and ``epoch_size`` don't apply, and the callbacks are read
+        again on every call.
+        """
+        assert self.valid_size == 0.0,\
+            "Specify a `valid_set` to validate incrementally, not `valid_size`."
+
+        X, y, w = self._prepare_chunk(X, y, w, fit=not self.is_initialized)
+        if not self.is_initialized:
+            backup, self.valid_set = self.valid_set, None
+            try:
+                X, y = self._initialize(X, y, w)
+            finally:
+                self.valid_set = backup
+
+        self._subscribe()
+        avg_train_error = self._backend._pass_impl(X, y, w)
+        if avg_train_error is not None and math.isnan(avg_train_error):
+            raise RuntimeError("Training diverged and returned NaN.")
+
+        avg_valid_error = None
+        if valid_set is not None:
+            avg_valid_error = self._backend._valid_impl(ChunkStream([valid_set]), None)
+        return avg_train_error, avg_valid_error
+
     def _predict(self, X):
+        X, _ = self._expand_windows(X)
+        X, = self._memory_map(X)
+        X, _, _ = self._convert_frames(X)
+        X, _, _ = self._convert_dtypes(X)
         X, _ = self._reshape(X)
 
         if self._backend is None:
@@ -272,17 +699,20 @@ class Regressor(MultiLayerPerceptron, sklearn.base.RegressorMixin):
     # Regressor compatible with sklearn that wraps various NN implementations.
     # The constructor and bulk of documentation is inherited from MultiLayerPerceptron.
 
-    def fit(self, X, y, w=None):
+    def fit(self, X, y=None, w=None):
         """Fit the neural network to the given continuous data as a regression problem.
 
         Parameters
         ----------
-        X : array-like, shape (n_samples, n_inputs)
+        X : array-like or str, shape (n_samples, n_inputs)
             Training vectors as real numbers, where n_samples is the number of
-            samples and n_inputs is the number of input features.
+            samples and n_inputs is the number of input features.  Filenames of
+            ``.npy`` files are opened as memory-mapped arrays, and instances of
+            :class:`sknn.data.SlidingWindows` provide windows over a time series.
 
-        y : array-like, shape (n_samples, n_outputs)
-            Target values are real numbers used as regression targets.
+        y : array-like or str, shape (n_samples, n_outputs)
+            Target values are real numbers used as regression targets.  Only optional
+            if the targets are provided by ``SlidingWindows``.
 
         w : array-like (optional), shape (n_samples) 
             Floating point weights for each of the training samples, used as mask to
@@ -294,18 +724,81 @@ class Regressor(MultiLayerPerceptron, sklearn.base.RegressorMixin):
             Returns this instance.
         """
 
+        self.copied_bytes.clear()
         if self.valid_set is not None:
-            self.valid_set = self._reshape(*self.valid_set)
+            X_v, y_v = self._expand_windows(*self.valid_set)
+            X_v, y_v, _ = self._convert_frames(*self._memory_map(X_v, y_v), phase='valid')
+            X_v, y_v, _ = self._convert_dtypes(X_v, y_v, phase='valid')
+            self.valid_set = self._reshape(X_v, y_v)
 
         return super(Regressor, self)._fit(X, y, w)
 
+    def fit_iter(self, chunks, valid_chunks=None):
+        """Fit the neural network to a stream of data chunks as a regression problem, for
+        datasets that are loaded or generated incrementally.  Each pass over all the chunks
+        is one epoch, so ``n_iter`` and ``n_stable`` apply to full passes over the source.
+
+        Parameters
+        ----------
+        chunks : callable or iterable
+            Source of ``(X, y)`` or ``(X, y, w)`` tuples of arrays, either a function that
+            returns a new iterator over the chunks for each epoch, or an iterable that can
+            be traversed multiple times, e.g. a list.  Generators only allow a single epoch.
+
+        valid_chunks : callable or iterable, optional
+            Source of validation chunks in the same format, used after each epoch.
+
+        Returns
+        -------
+        self : object
+            Returns this instance.
+        """
+        return super(Regressor, self)._fit_iter(chunks, valid_chunks)
+
+    def partial_fit(self, X, y=None, w=None, validate=False):
+        """Train the neural network incrementally with exactly one pass over the given samples,
+        for online learning.  The network is initialized on the first call, and later calls
+        reuse the compiled trainer, so their cost only depends on the size of the samples.
+        Each sample is used once, so ``sampling`` and ``epoch_size`` are ignored.
+
+        Parameters
+        ----------
+        X : array-like, shape (n_samples, n_inputs)
+            Training vectors as real numbers, or ``SlidingWindows`` over a time series.
+
+        y : array-like, shape (n_samples, n_outputs)
+            Target values are real numbers used as regression targets.
+
+        w : array-like (optional), shape (n_samples)
+            Floating point weights for each of the training samples.
+
+        validate : bool, optional
+            Also calculate the error on the ``valid_set`` after training, which is logged.
+
+        Returns
+        -------
+        self : object
+            Returns this instance.
+        """
+        valid_set = None
+        if validate:
+            assert self.valid_set is not None, "Specify a `valid_set` to validate incrementally."
+            X_v, y_v = self._expand_windows(*self.valid_set)
+            X_v, y_v, _ = self._convert_frames(X_v, y_v, phase='valid')
+            X_v, y_v, _ = self._convert_dtypes(X_v, y_v, phase='valid')
+            valid_set = self._reshape(X_v, y_v)
+
+        errors = super(Regressor, self)._partial_fit(X, y, w, valid_set)
+        log.debug("Partial fit with training error {} and validation error {}.".format(*errors))
+        return self
+
     def predict(self, X):
         """Calculate predictions for specified inputs.
 
         Parameters
         ----------
         X : array-like, shape (n_samples, n_inputs)
-            The input samples as real numbers.
+            The input samples as real numbers, or ``SlidingWindows`` over a series.
 
         Returns
         -------
@@ -346,11 +839,12 @@ class Classifier(MultiLayerPerceptron, sklearn.base.ClassifierMixin):
 
         Parameters
         ----------
-        X : array-like, shape (n_samples, n_features)
+        X : array-like or str, shape (n_samples, n_features)
             Training vectors as real numbers, where n_samples is the number of
-            samples and n_inputs is the number of input features.
+            samples and n_inputs is the number of input features.  Filenames of
+            ``.npy`` files are opened as memory-mapped arrays.
 
-        y : array-like, shape (n_samples, n_classes)
+        y : array-like or str, shape (n_samples, n_classes)
             Target values as integer symbols, for either single- or multi-output
             classification problems.
 
@@ -364,6 +858,8 @@ class Classifier(MultiLayerPerceptron, sklearn.base.ClassifierMixin):
             Returns this instance.
         """
 
+        self.copied_bytes.clear()
+        X, y, w = self._convert_frames(*self._memory_map(X, y, w), fit=True)
         assert X.shape[0] == y.shape[0],\
             "Expecting same number of input and output samples."
         if y.ndim == 1:
@@ -382,33 +878,115 @@ class Classifier(MultiLayerPerceptron, sklearn.base.ClassifierMixin):
         with self._patch_sklearn():
             ys = [lb.fit_transform(y[:,i]) for i, lb in enumerate(self.label_binarizers)]
         yp = numpy.concatenate(ys, axis=1).astype(theano.config.floatX)
+        self.copied_bytes['labels'] += yp.nbytes
 
         # Also transform the validation set if it was explicitly specified.
         if self.valid_set is not None:
-            X_v, y_v = self.valid_set
-            if y_v.ndim == 1:
-                y_v = y_v.reshape((y_v.shape[0], 1))
-            with self._patch_sklearn():
-                ys = [lb.transform(y_v[:,i]) for i, lb in enumerate(self.label_binarizers)]
-            y_vp = numpy.concatenate(ys, axis=1)
-            self.valid_set = (X_v, y_vp)
+            X_v, y_v, _ = self._convert_frames(*self._memory_map(*self.valid_set), phase='valid')
+            X_v, _, _ = self._convert_dtypes(X_v, phase='valid')
+            self.valid_set = (X_v, self._encode_labels(y_v, phase='valid'))
 
         # Now train based on a problem transformed into regression.
         return super(Classifier, self)._fit(X, yp, w)
 
-    def partial_fit(self, X, y, classes=None):
+    def _encode_labels(self, y, phase='labels'):
         if y.ndim == 1:
             y = y.reshape((y.shape[0], 1))
+        with self._patch_sklearn():
+            ys = [lb.transform(y[:,i]) for i, lb in enumerate(self.label_binarizers)]
+        yp = numpy.concatenate(ys, axis=1).astype(theano.config.floatX)
+        self.copied_bytes[phase] += yp.nbytes
+        return yp
+
+    def _fit_classes(self, classes):
+        if numpy.ndim(classes[0]) == 0:
+            classes = [classes]
+        LB = sklearn.preprocessing.LabelBinarizer
+        self.label_binarizers = [LB() for _ in range(len(classes))]
+        for lb, cls in zip(self.label_binarizers, classes):
+            lb.fit(cls)
+
+    def _prepare_chunk(self, X, y, w=None, fit=False, phase='convert'):
+        X, y = self._expand_windows(X, y)
+        X, y, w = self._convert_frames(X, y, w, fit=fit, phase=phase)
+        y = self._encode_labels(y, phase='labels' if phase == 'convert' else phase)
+        return super(Classifier, self)._prepare_chunk(X, y, w, phase=phase)
+
+    def fit_iter(self, chunks, classes=None, valid_chunks=None):
+        """Fit the neural network to a stream of data chunks as a classification problem.
+        Each pass over all the chunks is one epoch, so ``n_iter`` and ``n_stable`` apply to
+        full passes over the source.
+
+        Parameters
+        ----------
+        chunks : callable or iterable
+            Source of ``(X, y)`` or ``(X, y, w)`` tuples of arrays, either a function that
+            returns a new iterator over the chunks for each epoch, or an iterable that can
+            be traversed multiple times, e.g. a list.  Generators only allow a single epoch.
 
+        classes : list of arrays, optional
+            The labels of each output, required unless the classifier was already fitted,
+            since individual chunks may not contain all possible classes.
+
+        valid_chunks : callable or iterable, optional
+            Source of validation chunks in the same format, used after each epoch.
+
+        Returns
+        -------
+        self : object
+            Returns this instance.
+        """
         if classes is not None:
-            if isinstance(classes[0], int):
-                classes = [classes]
-            LB = sklearn.preprocessing.LabelBinarizer
-            self.label_binarizers = [LB() for _ in range(y.shape[1])]
-            for lb, cls in zip(self.label_binarizers, classes):
-                lb.fit(cls)
-
-        return self.fit(X, y)
+            self._fit_classes(classes)
+        assert self.label_binarizers != [],\
+            "Specify `classes` when streaming, since each chunk may not contain all labels."
+        return super(Classifier, self)._fit_iter(chunks, valid_chunks)
+
+    def partial_fit(self, X, y, classes=None, w=None, validate=False):
+        """Train the neural network incrementally with exactly one pass over the given samples,
+        for online learning.  The classes are fixed by the first call, and later calls reuse
+        both the class encoding and the compiled trainer.  Each sample is used once, so
+        ``sampling`` and ``epoch_size`` are ignored.
+
+        Parameters
+        ----------
+        X : array-like, shape (n_samples, n_features)
+            Training vectors as real numbers.
+
+        y : array-like, shape (n_samples, n_classes)
+            Target values as integer symbols, for either single- or multi-output
+            classification problems.
+
+        classes : list of arrays, optional
+            The labels of each output, required for the first call since individual calls
+            may not contain all possible classes.  Ignored once the classes are known.
+
+        w : array-like (optional), shape (n_samples)
+            Floating point weights for each of the training samples.
+
+        validate : bool, optional
+            Also calculate the error on the ``valid_set`` after training, which is logged.
+
+        Returns
+        -------
+        self : object
+            Returns this instance.
+        """
+        if not self.label_binarizers:
+            assert classes is not None,\
+                "Specify `classes` for the first call, since samples may not contain all labels."
+            self._fit_classes(classes)
+
+        valid_set = None
+        if validate:
+            assert self.valid_set is not None, "Specify a `valid_set` to validate incrementally."
+            X_v, y_v, _ = self._convert_frames(*self.valid_set, phase='valid')
+            X_v, _, _ = self._convert_dtypes(X_v, phase='valid')
+            valid_set = self._reshape(X_v, self._encode_labels(y_v, phase='valid'))
+
+        errors = super(Classifier, self)._partial_fit(X, y, w, valid_set)
+        log.debug("Partial fit with training error {} and validation error {}.".format(*errors))
+        return self
 
     def predict_proba(self, X, collapse=True):
         """Calculate probability estimates based on these input features.
@@ -16,6 +16,8 @@ log = logging.getLogger('sknn')
 import numpy
 import theano
 
+from .schedule import Schedule
+
 
 class ansi:
     BOLD = '\033[1;97m'
@@ -328,11 +330,165 @@ class NeuralNetwork(object):
         Real number indicating the momentum factor to be used for the
         learning rule 'momentum'. Default is ``0.9``.
 
+    learning_schedule: sknn.schedule.Schedule, optional
+        Schedule that changes the learning rate during training, starting from
+        ``learning_rate``, for example ``Step``, ``Exponential``, ``CosineRestarts``,
+        ``OneCycle`` or ``ReduceOnPlateau`` from the ``sknn.schedule`` module.  The rate
+        is stored in a shared variable, so updates do not rebuild the network.  By
+        default the learning rate is constant.
+
+    momentum_schedule: sknn.schedule.Schedule, optional
+        Schedule that changes the momentum during training, starting from
+        ``learning_momentum``.  By default the momentum is constant.
+
     batch_size: int, optional
         Number of training samples to group together when performing stochastic
         gradient descent (technically, a "minibatch").  By default each sample is
         treated on its own, with ``batch_size=1``.  Larger batches are usually faster.
 
+    shuffle_mode: str, optional
+        How the training samples are reordered at the start of each epoch, which also
+        determines whether batches need to be copied.  The options are:
+
+            * ``full`` — Each sample is shuffled individually, and batches are gathered
+              into buffers that are allocated once and reused (default).
+            * ``block`` — Contiguous blocks of ``batch_size`` samples are shuffled as a
+              whole, so the batches are passed as views of the input without copying.
+            * ``None`` — The samples are processed in the order they are specified.
+
+        Both ``block`` and ``None`` avoid copies only if the input array is C-contiguous
+        and already of type ``theano.config.floatX``.  For memory-mapped arrays, ``full``
+        shuffling only permutes samples within chunks of roughly 64 MB, in a random order
+        of chunks, so reading from disk remains mostly sequential.
+
+    epoch_size: int, optional
+        Number of training samples in each epoch, for datasets so large that a full pass
+        takes too long between validation checks.  Each epoch then selects the indices
+        of the next subset without copying any data, from a random permutation of the
+        training set if ``shuffle_mode`` is ``full``, or by rotating through the samples
+        in order otherwise.  All samples are used once before any of them are repeated.
+        ``n_iter``, ``n_stable`` and the callbacks then apply to these smaller epochs.
+        Default is ``None``, which uses the whole training set in every epoch.
+
+    sampling: str, optional
+        Strategy to draw the training samples of each epoch with replacement, instead of
+        using every sample once.  The number of samples is ``epoch_size`` if specified,
+        otherwise the size of the training set.
+
+            * ``balanced`` — For classifiers, each batch contains the same number of samples
+              of each class, based on the labels of the first output, within one sample if
+              ``batch_size`` isn't a multiple of the number of classes.  No importance
+              correction is applied, so the losses of all classes count equally rather than
+              in proportion to their frequency; the weights ``w`` are used unchanged.
+            * ``weighted`` — Samples are drawn with a probability proportional to their
+              weight ``w``, and the losses are then weighted uniformly by the mean of ``w``
+              instead, which corrects for the sampling so the expected loss is the same.
+            * ``loss`` — Samples are drawn with a priority based on their most recent loss,
+              which is stored in a table and updated from the loss of each example every
+              time it's trained.  Examples that are already fit well are rarely selected,
+              so the training focuses on the hard examples, as in selective backprop.
+
+        The order of batches is shuffled, but their content stays as sampled regardless of
+        ``shuffle_mode``.  Default is ``None``, which samples as specified by ``shuffle_mode``.
+
+    sampling_temperature: float, optional
+        For ``loss`` sampling, the priorities are the losses to the power of ``1.0 / T``, so
+        a higher temperature ``T`` samples more uniformly, and a lower temperature focuses
+        more on the examples with the highest losses.  Default is ``1.0``.
+
+    sampling_refresh: int, optional
+        For ``loss`` sampling, the number of epochs after which the losses of all training
+        examples are evaluated again, as the stored losses become stale for examples that
+        are rarely selected.  Default is ``10``, and ``None`` only evaluates them initially.
+
+    prefetch: int, optional
+        Number of batches to prepare in advance in a background thread, so that slicing,
+        type conversion and densifying of sparse data overlap with training.  The total
+        time spent waiting for batches is logged after training.  Default is ``None``,
+        which prepares each batch just before it is used.
+
+    device_resident: bool, optional
+        Store the whole training and validation sets in shared variables on the device
+        (e.g. GPU) once, so that each batch is selected by its indices within the compiled
+        functions rather than copied into the function for every call.  This is suitable
+        for datasets that fit into device memory, and requires dense ``numpy`` arrays.
+        Batch callbacks then receive ``None`` for the ``Xb``, ``yb`` and ``wb`` variables.
+        Default is ``False``.
+
+    fused_steps: int, optional
+        Number of consecutive minibatches to train within a single call to the compiled
+        function, via a loop in the computation graph, which reduces the Python overhead
+        for small networks or batches.  The ``on_batch_start`` and ``on_batch_finish``
+        callbacks are then called once per group of batches.  Default is ``None``, which
+        performs one update per call.
+
+    accumulate_steps: int, optional
+        Number of consecutive minibatches whose gradients are summed in shared buffers
+        before a single update is applied, which gives the statistics of a batch that is
+        ``accumulate_steps`` times larger with the peak memory of ``batch_size``.  Each
+        batch contributes in proportion to its number of samples, and sample weights
+        apply as usual.  The remaining batches at the end of an epoch are applied as a
+        smaller update.  Batch callbacks are still called for each minibatch.  Default
+        is ``None``, which updates the parameters after every batch.
+
+    sparse_input: bool, optional
+        Keep ``scipy.sparse`` inputs in CSR format throughout, both for training and for
+        predictions, and multiply them by the weights of the first layer with a sparse
+        dot product.  Memory and computation then scale with the number of non-zero
+        values rather than the number of columns.  The first layer must be a standard
+        :class:`sknn.mlp.Layer` without dropout.  Default is ``False``, which converts
+        each batch to a dense matrix.
+
+    input_scale: float, optional
+        Factor that multiplies the inputs within the compiled graph, e.g. ``1.0 / 255.0`` for
+        images.  Inputs of type ``uint8`` or ``uint16`` are kept in that type on the host and
+        in the batches, then cast to ``theano.config.floatX`` as the first operation of the
+        graph, so such datasets use a fraction of the memory.  The network then expects
+        inputs of the same type for training and for predictions.  Default is ``None``.
+
+    input_offset: float, optional
+        Value added to the inputs within the compiled graph, after ``input_scale`` was
+        applied.  Default is ``None``.
+
+    dtype_policy: str, optional
+        How the types of the dense input arrays are handled, compared to the floating point
+        type of the network in ``theano.config.floatX``, typically ``float32``.
+
+            * ``auto`` — Arrays are used as specified, and each batch is converted when
+              it's gathered for training or predictions (default).
+            * ``strict`` — Arrays of any other type raise a ``ValueError``, so no data can
+              be converted implicitly.  Compact ``uint8`` and ``uint16`` inputs are allowed.
+            * ``convert_once`` — Arrays are converted once before training or predicting,
+              which copies them, but makes every batch a view in the default modes.
+            * ``convert_inplace`` — Like ``convert_once``, but C-contiguous arrays with a
+              type of the same or larger size, e.g. ``float64``, are downcast chunk by chunk
+              within their own memory.  The arrays specified are then no longer valid.
+
+        Memory-mapped arrays and views with overlapping rows, e.g. ``SlidingWindows``, are
+        never converted up front, as that would load or expand them entirely.  The policy also applies to the
+        values of ``pandas`` frames, which are only copied if their columns have mixed types.
+        The number of bytes copied in each phase is logged after training and available in
+        the ``copied_bytes`` attribute: ``frames``, ``convert``, ``reshape``, ``labels`` for
+        the encoded classes, ``valid`` for the validation set, and ``batches``.
+
+    augment: callable, optional
+        Pure function applied to each training batch of inputs, which receives a ``numpy``
+        array of samples and returns an array of the same shape with augmented samples.
+        It's called by a pool of worker processes that write the results into a ring of
+        shared memory buffers, so the augmentation overlaps with training.  The workers are
+        started once per call to ``fit()`` and reused for all epochs; chunks of streams and
+        ``partial_fit()`` are augmented in the main process instead.  The global
+        ``numpy.random`` generator is seeded deterministically for each batch, based on the
+        current state of the generator in the main process.  The number of augmented
+        batches per second and the time spent waiting for them are logged after training.
+        Default is ``None``, which trains on the input data as specified.
+
+    augment_workers: int, optional
+        Number of worker processes used for ``augment``.  Specify ``0`` to apply the
+        function in the main process instead, which is also the fallback on platforms that
+        can't fork processes.  Default is ``None``, which uses one process less than the
+        number of CPUs.
+
     n_iter: int, optional
         The number of iterations of gradient descent to perform on the
         neural network's weights when training with ``fit()``.
@@ -341,7 +497,8 @@ class NeuralNetwork(object):
         Number of interations after which training should return when the validation
         error remains (near) constant.  This is usually a sign that the data has been
         fitted, or that optimization may have stalled.  If no validation set is specified,
-        then stability is judged based on the training error.  Default is ``10``.
+        then stability is judged based on the training error.  Only the epochs in which
+        validation took place are counted, see ``valid_every``.  Default is ``10``.
 
     f_stable: float, optional
         Threshold under which the validation error change is assumed to be stable, to
@@ -350,6 +507,15 @@ class NeuralNetwork(object):
         stable. The training set is used as fallback if there's no validation set. Default
         is ``0.001`.
 
+    max_time: float, optional
+        Budget of wall-clock time in seconds for each call to ``fit()``, which includes
+        preparing the data and compiling the network the first time.  The duration of
+        the next epoch is estimated from the previous ones, and training stops after the
+        last complete epoch that fits within the budget.  Within an epoch, training also
+        stops before a batch that is expected to exceed the budget, based on the average
+        duration of the previous batches.  The best parameters so far are then restored as
+        usual.  Default is ``None``, which does not limit the time.
+
     valid_set: tuple of array-like, optional
         Validation set (X_v, y_v) to be used explicitly while training.  Both
         arrays should have the same size for the first dimention, and the second
@@ -358,7 +524,61 @@ class NeuralNetwork(object):
     valid_size: float, optional
         Ratio of the training data to be used for validation.  0.0 means no
         validation, and 1.0 would mean there's no training data!  Common values are
-        0.1 or 0.25.
+        0.1 or 0.25.  The samples are split by indices without copying the data, and
+        for classifiers the split is stratified, which preserves class proportions in
+        both splits.  If the classes are too small for that, the samples are split
+        regardless of their class.
+
+    valid_every: int, optional
+        Number of epochs between evaluations of the validation set.  To validate after a
+        specific number of batches instead, set ``epoch_size`` to that many batches.
+        Default is ``1``, which validates after every epoch.
+
+    valid_samples: int, optional
+        Number of samples in a fixed random subset of the validation set, which is used
+        to estimate the validation error.  The whole validation set is only evaluated
+        when the estimate suggests a new best result, so the best parameters are always
+        selected based on the full error.  Schedules that react to plateaus observe the
+        estimate of every validated epoch, so they always compare errors from the same
+        subset.  Default is ``None``, which always evaluates the whole validation set, as
+        does a number that's not smaller than the validation set.
+
+    valid_budget: float, optional
+        Maximum ratio of the time spent validating compared to the time spent training;
+        validations that are due are skipped while this budget is exceeded.  Default is
+        ``None``, which validates as often as specified by ``valid_every``.
+
+    snapshot_mode: str, optional
+        Where the parameters of the best epoch so far are kept during training, which are
+        restored in place once training finishes.
+
+            * ``device`` — A second set of shared variables, updated by a compiled function
+              without any copies to the host (default).
+            * ``host`` — A list of ``numpy`` arrays in main memory.
+            * ``disk`` — Files in a temporary directory, written one parameter at a time,
+              for networks that are too large to be duplicated in memory.
+
+    checkpoint_dir: str, optional
+        Directory where the full state of training is stored, as a single file that's
+        replaced atomically: the parameters, the state of the learning rule (e.g. momentum
+        or Adam estimates), the schedules, the epoch counter and early stopping variables,
+        the best parameters so far and the random number generator.  A checkpoint is also
+        stored if the process receives ``SIGTERM`` during training, which then stops after
+        the current batch; the checkpoint then stores the position within the epoch, which
+        continues from there when resumed.  Default is ``None``, which never stores
+        checkpoints.
+
+    checkpoint_epochs: int, optional
+        Store a checkpoint every time this number of epochs has completed.
+
+    checkpoint_minutes: float, optional
+        Store a checkpoint after the first epoch that completes at least this number of
+        minutes after the previous checkpoint.
+
+    resume_from: str, optional
+        Checkpoint directory or file from which to continue training, with the same network
+        and training data, if it exists.  Typically the same as ``checkpoint_dir``, so jobs
+        that are interrupted can be started again with the same parameters.
 
     normalize: string, optional
         Enable normalization for all layers. Can be either `batch` for batch normalization
@@ -406,8 +626,24 @@ class NeuralNetwork(object):
             * ``on_epoch_finish`` — Called the first last when the iteration is done.
             * ``on_train_finish`` — Called just before the training function exits.
         
-        For each function, the ``variables`` dictionary passed contains all local variables within
-        the training implementation.
+        Only the events with a registered function are dispatched, so the others have no cost.
+        Each function receives a fixed set of ``variables`` as keyword arguments, so it should
+        also accept ``**kwargs`` for variables it does not use:
+
+            * All events — ``X``, ``y`` and ``w`` for the data being trained on.
+            * Epoch events — ``i`` the index of the epoch, and ``start_time``.  When finished,
+              also ``avg_train_error``, ``avg_valid_error``, ``sample_valid_error``,
+              ``best_train_error``, ``best_valid_error``, ``is_best_train``, ``is_best_valid``,
+              ``is_validated``, ``best_epoch``, ``n_stable`` and ``finish_time``; the training
+              finish event receives the same variables from the last epoch.  The error on the
+              full validation set and the estimate from ``valid_samples`` are kept separate,
+              so either may be ``None``.
+            * Batch events — ``Xb``, ``yb``, ``wb`` for the batch data, ``excerpt`` for the
+              selected samples, ``mode`` as either ``train`` or ``valid``, ``batch`` for
+              the index of the batch in the epoch and ``size`` for the number of samples.
+              When finished, also ``batch_time`` in seconds and ``running_loss``, a function
+              returning the average loss of the epoch so far.  Losses are accumulated on the
+              device, so only call it when the value is needed as it waits for the transfer.
 
     debug: bool, optional
         Should the underlying training algorithms perform validation on the data
@@ -440,16 +676,42 @@ class NeuralNetwork(object):
             learning_rule='sgd',
             learning_rate=0.01,
             learning_momentum=0.9,
+            learning_schedule=None,
+            momentum_schedule=None,
             normalize=None,
             regularize=None,
             weight_decay=None,
             dropout_rate=None,
             batch_size=1,
+            shuffle_mode='full',
+            epoch_size=None,
+            sampling=None,
+            sampling_temperature=1.0,
+            sampling_refresh=10,
+            prefetch=None,
+            device_resident=False,
+            fused_steps=None,
+            accumulate_steps=None,
+            sparse_input=False,
+            input_scale=None,
+            input_offset=None,
+            dtype_policy='auto',
+            augment=None,
+            augment_workers=None,
             n_iter=None,
             n_stable=10,
             f_stable=0.001,
+            max_time=None,
             valid_set=None,
             valid_size=0.0,
+            valid_every=1,
+            valid_samples=None,
+            valid_budget=None,
+            snapshot_mode='device',
+            checkpoint_dir=None,
+            checkpoint_epochs=None,
+            checkpoint_minutes=None,
+            resume_from=None,
             loss_type=None,
             callback=None,
             debug=False,
@@ -485,23 +747,64 @@ class NeuralNetwork(object):
             "Unknown type of regularization specified: %s." % regularize
         assert loss_type in ('mse', 'mae', 'mcc', None),\
             "Unknown loss function type specified: %s." % loss_type
+        assert shuffle_mode in ('full', 'block', None),\
+            "Unknown shuffle mode specified: %s." % shuffle_mode
+        assert sampling in ('balanced', 'weighted', 'loss', None),\
+            "Unknown sampling strategy specified: %s." % sampling
+        assert snapshot_mode in ('device', 'host', 'disk'),\
+            "Unknown snapshot mode specified: %s." % snapshot_mode
+        assert checkpoint_dir is not None or (checkpoint_epochs is None and checkpoint_minutes is None),\
+            "Specify a `checkpoint_dir` to store checkpoints periodically."
+        assert accumulate_steps is None or accumulate_steps >= 1,\
+            "Gradients must be accumulated over at least one batch: %s." % accumulate_steps
+        assert dtype_policy in ('auto', 'strict', 'convert_once', 'convert_inplace'),\
+            "Unknown dtype policy specified: %s." % dtype_policy
+        for schedule in (learning_schedule, momentum_schedule):
+            assert schedule is None or isinstance(schedule, Schedule),\
+                "Specify each schedule as an instance of a `sknn.schedule.Schedule` object."
 
         self.weights = parameters
         self.random_state = random_state
         self.learning_rule = learning_rule
         self.learning_rate = learning_rate
         self.learning_momentum = learning_momentum
+        self.learning_schedule = learning_schedule
+        self.momentum_schedule = momentum_schedule
         self.normalize = normalize
         self.regularize = regularize or ('dropout' if dropout_rate else None)\
                                      or ('L2' if weight_decay else None)
         self.weight_decay = weight_decay
         self.dropout_rate = dropout_rate
         self.batch_size = batch_size
+        self.shuffle_mode = shuffle_mode
+        self.epoch_size = epoch_size
+        self.sampling = sampling
+        self.sampling_temperature = sampling_temperature
+        self.sampling_refresh = sampling_refresh
+        self.prefetch = prefetch
+        self.device_resident = device_resident
+        self.fused_steps = fused_steps
+        self.accumulate_steps = accumulate_steps
+        self.sparse_input = sparse_input
+        self.input_scale = input_scale
+        self.input_offset = input_offset
+        self.dtype_policy = dtype_policy
+        self.augment = augment
+        self.augment_workers = augment_workers
         self.n_iter = n_iter
         self.n_stable = n_stable
         self.f_stable = f_stable
+        self.max_time = max_time
         self.valid_set = valid_set
         self.valid_size = valid_size
+        self.valid_every = valid_every
+        self.valid_samples = valid_samples
+        self.valid_budget = valid_budget
+        self.snapshot_mode = snapshot_mode
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_epochs = checkpoint_epochs
+        self.checkpoint_minutes = checkpoint_minutes
+        self.resume_from = resume_from
         self.loss_type = loss_type
         self.debug = debug
         self.verbose = verbose
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, unicode_literals, print_function)
+
+__all__ = ['Schedule', 'Step', 'Exponential', 'CosineRestarts', 'OneCycle', 'ReduceOnPlateau']
+
+import math
+
+
+class Schedule(object):
+    """Base class for schedules of the learning rate or momentum during training.  A schedule
+    computes the value for a given epoch from the initial value specified in the network, for
+    example ``learning_rate``.  The result is assigned to a shared variable that the compiled
+    trainer reads, so changing it does not require building the network again.
+
+    Epochs are counted from zero.  Schedules with ``per_batch`` set are also updated after
+    each training batch, using the fraction of the current epoch that was completed.
+    """
+
+    per_batch = False
+
+    def __call__(self, initial, epoch):
+        raise NotImplementedError
+
+    def reset(self):
+        """Called when training starts, to clear any state from previous training.
+        """
+        pass
+
+    def observe(self, error):
+        """Called after each epoch with the validation error, or the training error if there is
+        no validation set.  Epochs that were not validated are not observed.
+        """
+        pass
+
+    def __repr__(self):
+        params = ', '.join('%s=%r' % (k, v) for k, v in sorted(self.__dict__.items()) if not k.startswith('_'))
+        return '<sknn.schedule.%s `%s`>' % (self.__class__.__name__, params)
+
+
+class Step(Schedule):
+    """Multiply the initial value by ``factor`` once every ``step_size`` epochs.
+
+    Parameters
+    ----------
+
+    step_size: int
+        Number of epochs between two reductions of the value.
+
+    factor: float, optional
+        Multiplier applied at each step.  Default is ``0.1``.
+    """
+
+    def __init__(self, step_size, factor=0.1):
+        assert step_size >= 1, "The `step_size` of a schedule must be at least one epoch."
+        self.step_size = step_size
+        self.factor = factor
+
+    def __call__(self, initial, epoch):
+        return initial * self.factor ** int(epoch // self.step_size)
+
+
+class Exponential(Schedule):
+    """Multiply the initial value by ``decay`` for each epoch.
+
+    Parameters
+    ----------
+
+    decay: float
+        Multiplier applied after every epoch, for example ``0.95``.
+    """
+
+    def __init__(self, decay):
+        self.decay = decay
+
+    def __call__(self, initial, epoch):
+        return initial * self.decay ** int(epoch)
+
+
+class CosineRestarts(Schedule):
+    """Anneal the value from its initial value to ``minimum`` following a half cosine over each
+    cycle, then restart from the initial value.  The value is updated after each batch.
+
+    Parameters
+    ----------
+
+    period: int
+        Number of epochs in the first cycle.
+
+    multiplier: float, optional
+        Factor applied to the length of each cycle compared to the previous one.  Default
+        is ``1.0`` so all cycles have the same length.
+
+    minimum: float, optional
+        Value reached at the end of each cycle.  Default is ``0.0``.
+    """
+
+    per_batch = True
+
+    def __init__(self, period, multiplier=1.0, minimum=0.0):
+        assert period > 0 and multiplier >= 1.0,\
+            "Cosine restarts require a positive `period`, with a `multiplier` of at least 1.0."
+        self.period = period
+        self.multiplier = multiplier
+        self.minimum = minimum
+
+    def __call__(self, initial, epoch):
+        position, length = float(epoch), float(self.period)
+        if self.multiplier == 1.0:
+            position = position % length
+        else:
+            while position >= length:
+                position -= length
+                length *= self.multiplier
+        return self.minimum + (initial - self.minimum) * 0.5 * (1.0 + math.cos(math.pi * position / length))
+
+
+class OneCycle(Schedule):
+    """Move the value from its initial value to ``initial * peak`` over the first part of the
+    cycle, then to ``initial * final`` by its end, following half cosines.  The value then
+    stays constant.  It's updated after each batch.
+
+    For the learning rate, the peak is typically ten times the initial value; for the
+    momentum, a peak factor below one lowers it while the learning rate is high, and a final
+    factor of one brings it back.
+
+    Parameters
+    ----------
+
+    length: int
+        Number of epochs in the cycle, typically the same as ``n_iter``.
+
+    peak: float, optional
+        Factor of the initial value reached at the top of the cycle.  Default is ``10.0``.
+
+    warmup: float, optional
+        Fraction of the cycle spent moving towards the peak.  Default is ``0.3``.
+
+    final: float, optional
+        Factor of the initial value reached at the end of the cycle.  Default is ``0.01``.
+    """
+
+    per_batch = True
+
+    def __init__(self, length, peak=10.0, warmup=0.3, final=0.01):
+        assert length > 0 and 0.0 < warmup < 1.0,\
+            "A cycle requires a positive `length`, with a `warmup` fraction between zero and one."
+        self.length = length
+        self.peak = peak
+        self.warmup = warmup
+        self.final = final
+
+    def __call__(self, initial, epoch):
+        position = min(float(epoch) / self.length, 1.0)
+        if position < self.warmup:
+            start, end, t = 1.0, self.peak, position / self.warmup
+        else:
+            start, end, t = self.peak, self.final, (position - self.warmup) / (1.0 - self.warmup)
+        return initial * (end + (start - end) * 0.5 * (1.0 + math.cos(math.pi * t)))
+
+
+class ReduceOnPlateau(Schedule):
+    """Multiply the value by ``factor`` whenever the observed error has not improved for more
+    than ``patience`` validated epochs.  The error is the validation error if there's a
+    validation set, and otherwise the training error.
+
+    Parameters
+    ----------
+
+    factor: float, optional
+        Multiplier applied when the error reaches a plateau.  Default is ``0.1``.
+
+    patience: int, optional
+        Number of epochs without improvement that are tolerated.  Default is ``5``.
+
+    threshold: float, optional
+        Relative decrease of the error that counts as an improvement.  Default is ``1e-4``.
+
+    minimum: float, optional
+        The value is never reduced below this.  Default is ``0.0``.
+    """
+
+    def __init__(self, factor=0.1, patience=5, threshold=1e-4, minimum=0.0):
+        assert 0.0 < factor < 1.0, "The `factor` of a plateau must be between zero and one."
+        self.factor = factor
+        self.patience = patience
+        self.threshold = threshold
+        self.minimum = minimum
+        self.reset()
+
+    def reset(self):
+        self._best, self._wait, self._scale = float('inf'), 0, 1.0
+
+    def observe(self, error):
+        if error < self._best * (1.0 - self.threshold):
+            self._best, self._wait = error, 0
+            return
+
+        self._wait += 1
+        if self._wait > self.patience:
+            self._scale *= self.factor
+            self._wait = 0
+
+    def __call__(self, initial, epoch):
+        return max(initial * self._scale, self.minimum)
@@ -1,5 +1,5 @@
 import unittest
-from nose.tools import (assert_in, assert_raises, assert_equals)
+from nose.tools import (assert_in, assert_raises, assert_equals, assert_true)
 
 import collections
 import numpy
@@ -63,3 +63,37 @@ class TestSpecificCallback(unittest.TestCase):
         nn = MLP(layers=[L("Linear")], n_iter=1, batch_size=4, callback={'on_batch_start': self._callback})
         nn._fit(a_in, a_out)
         assert_equals(len(self.data), 2)
+
+
+class TestCallbackVariables(unittest.TestCase):
+
+    def setUp(self):
+        self.data = collections.defaultdict(list)
+
+    def _callback(self, event, **variables):
+        self.data[event].append(variables)
+
+    def test_BatchVariables(self):
+        a_in, a_out = numpy.zeros((8,16)), numpy.zeros((8,4))
+        nn = MLP(layers=[L("Linear")], n_iter=1, batch_size=3, callback=self._callback)
+        nn._fit(a_in, a_out)
+        finish = self.data['on_batch_finish']
+        assert_equals([0, 1, 2], [v['batch'] for v in finish])
+        assert_equals([3, 3, 2], [v['size'] for v in finish])
+        assert_equals('train', finish[0]['mode'])
+        assert_true(callable(finish[0]['running_loss']))
+        assert_in('batch_time', finish[0])
+
+    def test_EpochVariables(self):
+        a_in, a_out = numpy.zeros((8,16)), numpy.zeros((8,4))
+        nn = MLP(layers=[L("Linear")], n_iter=2, callback=self._callback)
+        nn._fit(a_in, a_out)
+        assert_equals([1, 2], [v['i'] for v in self.data['on_epoch_finish']])
+        assert_in('avg_train_error', self.data['on_train_finish'][0])
+        assert_true('self' not in self.data['on_epoch_finish'][0])
+
+    def test_UnsubscribedNotDispatched(self):
+        nn = MLP(layers=[L("Linear")], n_iter=1, callback={'on_epoch_finish': lambda **_: True})
+        nn._subscribe()
+        assert_equals(False, nn._has_callback('on_batch_start'))
+        assert_equals(True, nn._do_callback('on_batch_start', None))
@@ -33,6 +33,18 @@ class TestClassifierFunctionality(unittest.TestCase):
         self.nn.partial_fit(a_in, a_out, classes=[0,1,2,3])
         self.nn.partial_fit(a_in*2.0, a_out+1, classes=[0,1,2,3])
 
+    def test_PartialFitKeepsClassesAndTrainer(self):
+        a_in, a_out = numpy.zeros((8,4)), numpy.random.randint(0, 2, (8,))
+        self.nn.partial_fit(a_in, a_out, classes=[0,1,2])
+        trainer = self.nn._backend.trainer
+        self.nn.partial_fit(a_in, numpy.zeros((8,), dtype=numpy.int32))
+        assert_equal([0,1,2], list(self.nn.classes_[0]))
+        assert_true(self.nn._backend.trainer is trainer)
+
+    def test_PartialFitRequiresClasses(self):
+        a_in, a_out = numpy.zeros((8,4)), numpy.random.randint(0, 2, (8,))
+        assert_raises(AssertionError, self.nn.partial_fit, a_in, a_out)
+
     def test_PredictUninitializedNoUnitCount(self):
         a_in = numpy.zeros((8,16))
         assert_raises(AssertionError, self.nn.predict, a_in)
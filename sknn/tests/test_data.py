@@ -4,11 +4,13 @@ from nose.tools import (assert_greater, assert_less, assert_raises,\
                         assert_equals, assert_in, assert_true)
 
 import io
+import os
 import logging
 
 import numpy
 from sknn.mlp import Regressor as MLPR, Classifier as MLPC
 from sknn.mlp import Layer as L, Convolution as C
+from sknn.data import BatchPrefetcher, AugmentationPool, SlidingWindows
 
 
 class TestDataAugmentation(unittest.TestCase):
@@ -38,6 +40,244 @@ class TestDataAugmentation(unittest.TestCase):
         assert_raises(RuntimeError, self.nn._fit, a_in, a_out)
 
 
+class TestBatchPrefetcher(unittest.TestCase):
+
+    def test_SameOrder(self):
+        items = list(BatchPrefetcher(iter(range(100)), 4))
+        assert_equals(list(range(100)), items)
+
+    def test_ErrorForwarded(self):
+        def generate():
+            yield 1
+            raise ValueError("Expected")
+        p = BatchPrefetcher(generate(), 2)
+        assert_equals(1, next(p))
+        assert_raises(ValueError, next, p)
+
+    def test_CloseEarly(self):
+        p = BatchPrefetcher(iter(range(100)), 2)
+        assert_equals(0, next(p))
+        p.close()
+        assert_true(p.stall_time >= 0.0)
+
+    def test_TrainingCalledOK(self):
+        self.called = 0
+        def count(Xb, **_):
+            self.called += 1
+        nn = MLPR(layers=[L("Linear")], n_iter=2, batch_size=2, prefetch=2,
+                  callback={'on_batch_start': count})
+        a_in, a_out = numpy.zeros((8,16)), numpy.zeros((8,4))
+        nn.fit(a_in, a_out)
+        assert_equals(8, self.called)
+
+
+def _noisy(Xb):
+    return Xb + numpy.random.uniform(0.0, 1.0, Xb.shape)
+
+
+def _process_id(Xb):
+    return numpy.full(Xb.shape, os.getpid() % 4096)
+
+
+def _exit(Xb):
+    os._exit(3)
+
+
+class TestAugmentationPool(unittest.TestCase):
+
+    def setUp(self):
+        self.X = numpy.arange(40, dtype=numpy.float64).reshape((20,2))
+
+    def iterate(self, function, excerpts, workers=2, ring=1):
+        pool = AugmentationPool(self.X, function, 4, numpy.float32, workers, ring=ring)
+        try:
+            return [(Xb.copy(), e) for Xb, e in pool.iterate(excerpts)]
+        finally:
+            pool.close()
+
+    def test_SameOrder(self):
+        excerpts = [numpy.random.permutation(20)[:4] for _ in range(8)] + [slice(16, 19)]
+        for Xb, excerpt in self.iterate(numpy.negative, excerpts, ring=3):
+            assert_true(numpy.all(Xb == -self.X[excerpt]))
+
+    def test_DeterministicSeeding(self):
+        excerpts = [slice(s, s+4) for s in range(0, 20, 4)]
+        numpy.random.seed(1234)
+        b1 = self.iterate(_noisy, excerpts, workers=3)
+        numpy.random.seed(1234)
+        b2 = self.iterate(_noisy, excerpts, workers=1)
+        assert_true(all(numpy.all(x1 == x2) for (x1, _), (x2, _) in zip(b1, b2)))
+
+    def test_ErrorForwarded(self):
+        def fail(Xb):
+            raise ValueError("Expected")
+        assert_raises(ValueError, self.iterate, fail, [slice(0, 4)])
+
+    def test_WorkerExitRaises(self):
+        assert_raises(RuntimeError, self.iterate, _exit, [slice(0, 4), slice(4, 8)])
+
+    def test_ReusedAfterEarlyStop(self):
+        pool = AugmentationPool(self.X, numpy.negative, 4, numpy.float32, 2, ring=1)
+        try:
+            for Xb, excerpt in pool.iterate([slice(s, s+4) for s in range(0, 20, 4)]):
+                break
+            batches = [(Xb.copy(), e) for Xb, e in pool.iterate([slice(8, 12), slice(0, 4)])]
+        finally:
+            pool.close()
+        assert_equals([slice(8, 12), slice(0, 4)], [e for _, e in batches])
+        assert_true(all(numpy.all(Xb == -self.X[e]) for Xb, e in batches))
+
+    def test_WorkersReusedAcrossEpochs(self):
+        self.processes = set()
+        def store(Xb, **_):
+            self.processes.update(numpy.unique(Xb).tolist())
+        nn = MLPR(layers=[L("Linear")], n_iter=4, batch_size=2, augment=_process_id,
+                  augment_workers=2, callback={'on_batch_start': store})
+        nn.fit(numpy.ones((8,16)), numpy.zeros((8,4)))
+        assert_true(len(self.processes) <= 2)
+
+    def test_TrainingWithWorkers(self):
+        for workers in [0, 2]:
+            self.batches = []
+            def store(Xb, **_):
+                self.batches.append(Xb.copy())
+            nn = MLPR(layers=[L("Linear")], n_iter=2, batch_size=2, prefetch=1,
+                      augment=numpy.negative, augment_workers=workers,
+                      callback={'on_batch_start': store})
+            nn.fit(numpy.ones((8,16)), numpy.zeros((8,4)))
+            assert_equals(8, len(self.batches))
+            assert_true(all(numpy.all(Xb == -1.0) for Xb in self.batches))
+
+
+class TestSlidingWindows(unittest.TestCase):
+
+    def setUp(self):
+        self.series = numpy.random.uniform(-1.0, +1.0, (50,3))
+
+    def test_WindowsAreViews(self):
+        ds = SlidingWindows(self.series, window=4, stride=2, horizon=3)
+        assert_equals((22,12), ds.X.shape)
+        assert_true(numpy.may_share_memory(ds.X, self.series))
+        assert_true(numpy.all(ds.X[5] == self.series[10:14].ravel()))
+        assert_true(numpy.all(ds.y[5] == self.series[16]))
+        assert_raises(ValueError, ds.X.__setitem__, 0, 0.0)
+
+    def test_PredictAllWindows(self):
+        ds = SlidingWindows(self.series, window=5, horizon=None)
+        assert_equals(46, len(ds))
+        assert_true(ds.y is None)
+
+    def test_SameAsMaterialized(self):
+        ds = SlidingWindows(self.series[:,0], window=6)
+        X = numpy.array([self.series[i:i+6,0] for i in range(len(ds))])
+        y = self.series[6:,0]
+        nn1 = MLPR(layers=[L("Linear")], n_iter=2, batch_size=4, random_state=1, valid_size=0.2)
+        nn1.fit(ds)
+        nn2 = MLPR(layers=[L("Linear")], n_iter=2, batch_size=4, random_state=1, valid_size=0.2)
+        nn2.fit(X, y)
+        assert_true(numpy.allclose(nn1.predict(ds), nn2.predict(X), atol=1E-5))
+
+
+class TestDeviceResident(unittest.TestCase):
+
+    def test_SameAsHostTraining(self):
+        a_in = numpy.random.uniform(-1.0, +1.0, (8,16))
+        a_out = numpy.random.uniform(-1.0, +1.0, (8,4))
+        nn1 = MLPR(layers=[L("Linear")], n_iter=2, batch_size=3, random_state=1, shuffle_mode=None)
+        nn2 = MLPR(layers=[L("Linear")], n_iter=2, batch_size=3, random_state=1, shuffle_mode=None,
+                   device_resident=True)
+        nn1.fit(a_in, a_out)
+        nn2.fit(a_in, a_out)
+        p1, p2 = nn1.get_parameters(), nn2.get_parameters()
+        assert_true(numpy.allclose(p1[0].weights, p2[0].weights, atol=1E-5))
+
+    def test_WeightsAndValidation(self):
+        a_in, a_out = numpy.zeros((8,16)), numpy.zeros((8,4))
+        nn = MLPR(layers=[L("Linear")], n_iter=2, batch_size=3, device_resident=True, valid_size=0.25)
+        nn.fit(a_in, a_out, numpy.ones((8,)))
+        assert_equals((8,4), nn.predict(a_in).shape)
+
+    def test_CallbackNoData(self):
+        self.batches = []
+        def store(Xb, excerpt, **_):
+            self.batches.append((Xb, excerpt))
+        nn = MLPR(layers=[L("Linear")], n_iter=2, batch_size=3, device_resident=True,
+                  callback={'on_batch_start': store})
+        nn.fit(numpy.zeros((8,16)), numpy.zeros((8,4)))
+        assert_equals(6, len(self.batches))
+        assert_true(all(Xb is None for Xb, _ in self.batches))
+
+
+class TestStreamingFit(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+
+    def _callback(self, event, **_):
+        self.events.append(event)
+
+    def chunks(self):
+        for i in range(3):
+            yield numpy.random.uniform(-1.0, +1.0, (4,16)), numpy.zeros((4,4))
+
+    def test_MultiplePasses(self):
+        nn = MLPR(layers=[L("Linear")], n_iter=2, batch_size=2, callback=self._callback)
+        nn.fit_iter(self.chunks)
+        assert_equals(2, self.events.count('on_epoch_start'))
+        assert_equals(12, self.events.count('on_batch_start'))
+        assert_equals((4,4), nn.predict(numpy.zeros((4,16))).shape)
+
+    def test_ValidationStream(self):
+        errors = []
+        def store(avg_valid_error, **_):
+            errors.append(avg_valid_error)
+        nn = MLPR(layers=[L("Linear")], n_iter=2, callback={'on_epoch_finish': store})
+        nn.fit_iter(list(self.chunks()), valid_chunks=self.chunks)
+        assert_equals(2, len(errors))
+        assert_true(all(e is not None for e in errors))
+        assert_true(nn.valid_set is None)
+
+    def test_GeneratorSinglePass(self):
+        nn = MLPR(layers=[L("Linear")], n_iter=2)
+        assert_raises(ValueError, nn.fit_iter, self.chunks())
+
+    def test_ClassifierRequiresClasses(self):
+        def chunks():
+            for i in range(3):
+                yield numpy.zeros((4,16)), numpy.random.randint(3, size=(4,))
+        nn = MLPC(layers=[L("Softmax")], n_iter=1)
+        assert_raises(AssertionError, nn.fit_iter, chunks)
+        nn.fit_iter(chunks, classes=[0, 1, 2])
+        assert_equals((4,3), nn.predict_proba(numpy.zeros((4,16))).shape)
+
+    def test_ClassifierValidSet(self):
+        errors = []
+        def chunks():
+            for i in range(3):
+                yield numpy.zeros((4,16)), numpy.array([0, 1, 2, 1])
+        nn = MLPC(layers=[L("Softmax")], n_iter=2, valid_set=(numpy.zeros((4,16)), numpy.array([2, 1, 0, 1])),
+                  callback={'on_epoch_finish': lambda avg_valid_error, **_: errors.append(avg_valid_error)})
+        nn.fit_iter(chunks, classes=[0, 1, 2])
+        assert_equals(2, len(errors))
+        assert_true(all(e is not None and e > 0.0 for e in errors))
+        assert_equals((4,), nn.valid_set[1].shape)
+
+    def test_ChunksFollowPolicy(self):
+        nn = MLPR(layers=[L("Linear")], n_iter=1, dtype_policy='strict')
+        assert_raises(ValueError, nn.fit_iter, lambda: self.chunks())
+        nn = MLPR(layers=[L("Linear")], n_iter=1, dtype_policy='convert_once')
+        nn.fit_iter(lambda: self.chunks())
+        assert_greater(nn.copied_bytes['convert'], 0)
+
+    def test_SlidingWindowChunks(self):
+        def chunks():
+            for i in range(3):
+                yield SlidingWindows(numpy.random.uniform(-1.0, +1.0, (12,2)), window=4), None
+        nn = MLPR(layers=[L("Linear")], n_iter=1, batch_size=3, callback=self._callback)
+        nn.fit_iter(chunks)
+        assert_equals(3 * 3, self.events.count('on_batch_start'))
+
+
 class TestNetworkParameters(unittest.TestCase):
     
     def setUp(self):
@@ -0,0 +1,74 @@
+import unittest
+from nose.tools import (assert_equals, assert_true, assert_raises, assert_almost_equals)
+
+import numpy
+from sknn.mlp import Regressor as MLPR, Layer as L
+from sknn.schedule import (Step, Exponential, CosineRestarts, OneCycle, ReduceOnPlateau)
+
+
+class TestScheduleValues(unittest.TestCase):
+
+    def test_Step(self):
+        s = Step(step_size=2, factor=0.5)
+        assert_equals([1.0, 1.0, 0.5, 0.5, 0.25], [s(1.0, e) for e in range(5)])
+
+    def test_Exponential(self):
+        s = Exponential(decay=0.5)
+        assert_almost_equals(0.125, s(1.0, 3))
+
+    def test_CosineRestarts(self):
+        s = CosineRestarts(period=4, minimum=0.1)
+        assert_almost_equals(1.0, s(1.0, 0))
+        assert_almost_equals(0.55, s(1.0, 2))
+        assert_almost_equals(1.0, s(1.0, 4))
+
+    def test_CosineLongerCycles(self):
+        s = CosineRestarts(period=2, multiplier=2.0)
+        assert_almost_equals(1.0, s(1.0, 2))
+        assert_almost_equals(0.5, s(1.0, 4))
+        assert_almost_equals(1.0, s(1.0, 6))
+
+    def test_OneCycle(self):
+        s = OneCycle(length=10, peak=10.0, warmup=0.5, final=0.5)
+        assert_almost_equals(1.0, s(1.0, 0))
+        assert_almost_equals(10.0, s(1.0, 5))
+        assert_almost_equals(0.5, s(1.0, 10))
+        assert_almost_equals(0.5, s(1.0, 20))
+
+    def test_ReduceOnPlateau(self):
+        s = ReduceOnPlateau(factor=0.5, patience=1)
+        for error in [1.0, 0.5, 0.5, 0.5]:
+            s.observe(error)
+        assert_almost_equals(0.5, s(1.0, 4))
+        s.reset()
+        assert_almost_equals(1.0, s(1.0, 0))
+
+    def test_InvalidSchedule(self):
+        assert_raises(AssertionError, MLPR, layers=[L("Linear")], learning_schedule=0.1)
+
+
+class TestScheduleTraining(unittest.TestCase):
+
+    def setUp(self):
+        self.rates = []
+
+    def _epoch(self, **_):
+        self.rates.append(float(self.nn._backend.rate_shared.get_value()))
+
+    def test_RateChangesPerEpoch(self):
+        self.nn = MLPR(layers=[L("Linear")], n_iter=3, learning_rate=0.01,
+                       learning_schedule=Exponential(0.5), callback={'on_epoch_finish': self._epoch})
+        self.nn.fit(numpy.zeros((8,4)), numpy.zeros((8,2)))
+        numpy.testing.assert_allclose([0.01, 0.005, 0.0025], self.rates, rtol=1e-5)
+
+    def test_RateChangesPerBatch(self):
+        self.nn = MLPR(layers=[L("Linear")], n_iter=1, batch_size=2, learning_rate=0.01,
+                       learning_schedule=CosineRestarts(period=1), callback={'on_batch_finish': self._epoch})
+        self.nn.fit(numpy.zeros((8,4)), numpy.zeros((8,2)))
+        assert_true(self.rates[0] > self.rates[1] > self.rates[2])
+
+    def test_MomentumShared(self):
+        self.nn = MLPR(layers=[L("Linear")], n_iter=2, learning_rule='momentum',
+                       momentum_schedule=Step(step_size=1, factor=0.5))
+        self.nn.fit(numpy.zeros((8,4)), numpy.zeros((8,2)))
+        assert_almost_equals(0.45, float(self.nn._backend.momentum_shared.get_value()), places=5)
@@ -1,10 +1,17 @@
 import unittest
-from nose.tools import (assert_in, assert_raises, assert_equals)
+from nose.tools import (assert_in, assert_raises, assert_equals, assert_true, assert_false)
 
 import io
+import os
+import time
+import pickle
+import shutil
+import signal
 import logging
+import tempfile
 
 import numpy
+import theano
 from sknn.mlp import MultiLayerPerceptron as MLP
 from sknn.mlp import Regressor as MLPR
 from sknn.mlp import Classifier as MLPC
@@ -13,6 +20,21 @@ from sknn.mlp import Layer as L
 import sknn.mlp
 
 
+def linear(**kwargs):
+    """Build a small linear regressor that trains the same way on every run."""
+    params = dict(layers=[L("Linear")], n_iter=2, batch_size=4, random_state=1, shuffle_mode=None)
+    params.update(kwargs)
+    return MLPR(**params)
+
+
+def assert_same_training(nn1, nn2, *data):
+    nn1.fit(*data)
+    nn2.fit(*data)
+    p1, p2 = nn1.get_parameters(), nn2.get_parameters()
+    assert_true(numpy.allclose(p1[0].weights, p2[0].weights, atol=1E-5))
+    assert_true(numpy.allclose(p1[0].biases, p2[0].biases, atol=1E-5))
+
+
 class TestTrainingProcedure(unittest.TestCase):
 
     def test_FitTerminateStable(self):
@@ -34,6 +56,38 @@ class TestTrainingProcedure(unittest.TestCase):
 
         self.nn._fit(a_in, a_out)
         
+    def test_ValidationSplitNoCopy(self):
+        a_in, a_out = numpy.zeros((8,16)), numpy.zeros((8,4))
+        self.nn = MLP(layers=[L("Linear")], n_iter=1, valid_size=0.25)
+        self.nn._fit(a_in, a_out)
+
+        train, valid = self.nn._backend.train_split[1], self.nn._backend.valid_split[1]
+        assert_equals(list(range(8)), sorted(numpy.concatenate([train, valid])))
+        assert_equals(2, len(valid))
+        assert_true(self.nn.valid_set[0] is a_in)
+
+    def test_ValidationSplitStratified(self):
+        a_in = numpy.zeros((24,16))
+        a_out = numpy.array([0] * 20 + [1] * 4, dtype=numpy.int32)
+        self.nn = MLPC(layers=[L("Softmax")], n_iter=1, valid_size=0.25)
+        self.nn.fit(a_in, a_out)
+
+        valid = self.nn._backend.valid_split[1]
+        assert_equals(5, (a_out[valid] == 0).sum())
+        assert_equals(1, (a_out[valid] == 1).sum())
+
+    def test_ValidationSplitSmallClasses(self):
+        a_in = numpy.zeros((8,16))
+        a_out = numpy.array([0, 0, 1, 1, 2, 2, 3, 3], dtype=numpy.int32)
+        self.nn = MLPC(layers=[L("Softmax")], n_iter=1, valid_size=0.25)
+        self.nn.fit(a_in, a_out)
+        assert_equals(2, len(self.nn._backend.valid_split[1]))
+        assert_equals(6, len(self.nn._backend.train_split[1]))
+
+    def test_ValidationSplitTooSmall(self):
+        self.nn = MLP(layers=[L("Linear")], n_iter=1, valid_size=0.25)
+        assert_raises(ValueError, self.nn._fit, numpy.zeros((1,16)), numpy.zeros((1,4)))
+
     def test_TrainingInfinite(self):
         a_in, a_out = numpy.zeros((8,16)), numpy.zeros((8,4))
         self.nn = MLP(layers=[L("Linear")], n_iter=None, n_stable=None)
@@ -90,6 +144,511 @@ class TestBatchSize(unittest.TestCase):
         assert_equals(9, self.batch_items)
 
 
+class TestBatchIterator(unittest.TestCase):
+
+    def setUp(self):
+        self.a_in = numpy.random.uniform(-1.0, +1.0, (10,16)).astype(theano.config.floatX)
+        self.a_out = numpy.zeros((10,4), dtype=theano.config.floatX)
+        self.nn = MLP(layers=[L("Linear")], n_iter=1, batch_size=4)
+        self.nn._initialize(self.a_in, self.a_out)
+
+    def iterate(self, X, **kwargs):
+        # Gathered batches reuse the same buffer, so they must be checked as they are yielded.
+        return self.nn._backend._iterate_data(4, X, self.a_out, **kwargs)
+
+    def test_SequentialViews(self):
+        for Xb, _, _, idx in self.iterate(self.a_in, shuffle=False):
+            assert_true(numpy.may_share_memory(Xb, self.a_in))
+            assert_true((Xb == self.a_in[idx]).all())
+
+    def test_BlockShuffleViews(self):
+        batches = list(self.iterate(self.a_in, shuffle='block'))
+        assert_equals([3, 4, 4, 4], sorted(Xb.shape[0] for Xb, _, _, _ in batches))
+        for Xb, _, _, idx in batches:
+            assert_true(numpy.may_share_memory(Xb, self.a_in))
+            assert_true((Xb == self.a_in[idx]).all())
+
+    def test_FullShuffleGather(self):
+        seen = []
+        for Xb, _, _, idx in self.iterate(self.a_in, shuffle=True):
+            assert_false(numpy.may_share_memory(Xb, self.a_in))
+            assert_true((Xb == self.a_in[idx]).all())
+            seen.extend(idx)
+        assert_equals(list(range(10)), sorted(seen))
+
+    def test_CopyRequested(self):
+        for Xb, _, _, _ in self.iterate(self.a_in, shuffle=False, copy=True):
+            assert_false(numpy.may_share_memory(Xb, self.a_in))
+
+    def test_ConvertType(self):
+        a_in = self.a_in.astype(numpy.float16)
+        for Xb, _, _, idx in self.iterate(a_in, shuffle=True):
+            assert_equals(Xb.dtype, numpy.dtype(theano.config.floatX))
+            assert_true((Xb == a_in[idx]).all())
+
+    def test_GatherReusesBuffer(self):
+        batches = [Xb for Xb, _, _, _ in self.iterate(self.a_in, shuffle=True)]
+        assert_true(batches[0].base is not None)
+        assert_true(all(Xb.base is batches[0].base for Xb in batches))
+
+    def test_InvalidIndices(self):
+        assert_raises(IndexError, self.iterate, self.a_in, indices=numpy.array([0, 10]))
+        assert_raises(IndexError, self.iterate, self.a_in, indices=numpy.array([-1, 2]))
+
+    def test_MutationDoesNotAlias(self):
+        def mutate(Xb, **_):
+            Xb += 1.0
+        a_copy = self.a_in.copy()
+        nn = MLP(layers=[L("Linear")], n_iter=1, batch_size=4, shuffle_mode=None,
+                 callback={'on_batch_start': mutate})
+        nn._fit(self.a_in, self.a_out)
+        assert_true((a_copy == self.a_in).all())
+
+
+class TestFusedSteps(unittest.TestCase):
+
+    def setUp(self):
+        self.a_in = numpy.random.uniform(-1.0, +1.0, (9,16))
+        self.a_out = numpy.random.uniform(-1.0, +1.0, (9,4))
+
+    def test_SameAsSingleSteps(self):
+        assert_same_training(linear(batch_size=2), linear(batch_size=2, fused_steps=3),
+                             self.a_in, self.a_out)
+
+    def test_SameOnDevice(self):
+        assert_same_training(linear(batch_size=2, device_resident=True),
+                             linear(batch_size=2, device_resident=True, fused_steps=3),
+                             self.a_in, self.a_out)
+
+    def test_BatchCallbacks(self):
+        self.batches = []
+        def store(Xb, **_):
+            self.batches.append(Xb.shape[0])
+        nn = linear(batch_size=2, fused_steps=3, callback={'on_batch_start': store})
+        nn.fit(numpy.zeros((9,16)), numpy.zeros((9,4)))
+        assert_equals([6, 3, 6, 3], self.batches)
+
+
+class TestAccumulateSteps(unittest.TestCase):
+
+    def setUp(self):
+        self.a_in = numpy.random.uniform(-1.0, +1.0, (9,16))
+        self.a_out = numpy.random.uniform(-1.0, +1.0, (9,4))
+        self.a_w = numpy.random.uniform(0.5, 1.5, (9,))
+
+    def test_SameAsLargerBatches(self):
+        assert_same_training(linear(batch_size=4), linear(batch_size=2, accumulate_steps=2),
+                             self.a_in, self.a_out, self.a_w)
+
+    def test_SameOnDevice(self):
+        assert_same_training(linear(batch_size=4, device_resident=True),
+                             linear(batch_size=2, accumulate_steps=2, device_resident=True),
+                             self.a_in, self.a_out, self.a_w)
+
+    def test_BatchCallbacks(self):
+        self.batches = []
+        nn = linear(batch_size=2, accumulate_steps=2,
+                    callback={'on_batch_finish': lambda **_: self.batches.append(1)})
+        nn.fit(numpy.zeros((9,16)), numpy.zeros((9,4)))
+        assert_equals(10, len(self.batches))
+
+    def test_NotWithFusedSteps(self):
+        nn = linear(batch_size=2, accumulate_steps=2, fused_steps=2)
+        assert_raises(AssertionError, nn.fit, numpy.zeros((9,16)), numpy.zeros((9,4)))
+
+
+class TestEpochSize(unittest.TestCase):
+
+    def fit(self, **kwargs):
+        self.epochs = []
+        def start(**_):
+            self.epochs.append([])
+        def store(excerpt, **_):
+            self.epochs[-1].extend(numpy.arange(20)[excerpt])
+        nn = MLPR(layers=[L("Linear")], n_iter=4, batch_size=2, epoch_size=5,
+                  callback={'on_epoch_start': start, 'on_batch_start': store}, **kwargs)
+        nn.fit(numpy.zeros((20,4)), numpy.zeros((20,2)))
+
+    def test_RandomSubsets(self):
+        self.fit()
+        assert_equals([5, 5, 5, 5], [len(e) for e in self.epochs])
+        assert_equals(list(range(20)), sorted(sum(self.epochs, [])))
+
+    def test_RotatingSubsets(self):
+        self.fit(shuffle_mode=None)
+        assert_equals(list(range(20)), sum(self.epochs, []))
+
+    def test_ValidationSplit(self):
+        self.fit(valid_size=0.25)
+        assert_true(all(len(e) == 5 for e in self.epochs))
+
+
+class TestSampling(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+
+    def _store(self, yb, wb, excerpt, **_):
+        self.batches.append((yb.copy(), None if wb is None else wb.copy(), excerpt))
+
+    def test_BalancedBatches(self):
+        y = numpy.array([0] * 18 + [1] * 2)
+        nn = MLPC(layers=[L("Softmax")], n_iter=1, batch_size=4, sampling='balanced',
+                  callback={'on_batch_start': self._store})
+        nn.fit(numpy.zeros((20,4)), y)
+        assert_equals(5, len(self.batches))
+        assert_true(all(numpy.all(yb.sum(axis=0) == 2) for yb, _, _ in self.batches))
+
+    def test_BalancedQuotas(self):
+        y = numpy.array([0] * 15 + [1] * 3 + [2] * 2)
+        nn = MLPC(layers=[L("Softmax")], n_iter=1, batch_size=4, sampling='balanced',
+                  callback={'on_batch_start': self._store})
+        nn.fit(numpy.zeros((20,4)), y)
+        assert_equals(5, len(self.batches))
+        assert_true(all(sorted(yb.sum(axis=0)) == [1, 1, 2] for yb, _, _ in self.batches))
+
+    def test_BalancedWeightsUnchanged(self):
+        y, w = numpy.array([0] * 18 + [1] * 2), numpy.linspace(0.5, 1.5, 20)
+        nn = MLPC(layers=[L("Softmax")], n_iter=1, batch_size=4, sampling='balanced',
+                  callback={'on_batch_start': self._store})
+        nn.fit(numpy.zeros((20,4)), y, w)
+        assert_true(all(numpy.allclose(wb, w[e]) for _, wb, e in self.batches))
+
+    def test_BalancedRequiresClassifier(self):
+        nn = MLPR(layers=[L("Linear")], n_iter=1, sampling='balanced')
+        assert_raises(AssertionError, nn.fit, numpy.zeros((8,4)), numpy.zeros((8,2)))
+
+    def test_WeightedCorrected(self):
+        w = numpy.array([0.0] * 10 + [3.0] * 10)
+        nn = MLPR(layers=[L("Linear")], n_iter=2, batch_size=5, epoch_size=10, sampling='weighted',
+                  callback={'on_batch_start': self._store})
+        nn.fit(numpy.zeros((20,4)), numpy.zeros((20,2)), w)
+        assert_equals(4, len(self.batches))
+        assert_true(all(numpy.all(e >= 10) for _, _, e in self.batches))
+        assert_true(all(numpy.allclose(wb, 1.5) for _, wb, _ in self.batches))
+
+
+class TestLossSampling(unittest.TestCase):
+
+    def test_LossTableUpdated(self):
+        nn = MLPR(layers=[L("Linear")], n_iter=3, batch_size=4, sampling='loss')
+        nn.fit(numpy.random.uniform(-1.0, +1.0, (20,4)), numpy.random.uniform(-1.0, +1.0, (20,2)))
+        table = nn._backend.loss_table
+        assert_equals((20,), table.shape)
+        assert_true(numpy.all(table > 0.0))
+
+    def test_PrioritizeHighLoss(self):
+        self.excerpts = []
+        def store(excerpt, **_):
+            self.excerpts.extend(excerpt)
+        X, y = numpy.zeros((40,4)), numpy.zeros((40,2))
+        y[:4] = 100.0
+        nn = MLPR(layers=[L("Linear")], n_iter=3, batch_size=4, sampling='loss', random_state=1,
+                  sampling_temperature=0.5, callback={'on_batch_start': store})
+        nn.fit(X, y)
+        assert_true(sum(e < 4 for e in self.excerpts) > len(self.excerpts) // 2)
+
+    def test_FusedUnsupported(self):
+        nn = MLPR(layers=[L("Linear")], batch_size=4, sampling='loss', fused_steps=2)
+        assert_raises(AssertionError, nn.fit, numpy.zeros((8,4)), numpy.zeros((8,2)))
+
+
+class TestSnapshots(unittest.TestCase):
+
+    def check(self, mode):
+        self.best = None
+        def store(is_best_valid, **_):
+            if is_best_valid:
+                self.best = nn.get_parameters()[0].weights.copy()
+        nn = MLPR(layers=[L("Linear")], n_iter=6, learning_rate=0.5, snapshot_mode=mode,
+                  random_state=1, callback={'on_epoch_finish': store})
+        X, y = numpy.random.uniform(-1.0, +1.0, (16,4)), numpy.random.uniform(-1.0, +1.0, (16,2))
+        nn.valid_set = (X[:4], y[:4])
+        nn.fit(X[4:], y[4:])
+        assert_true(self.best is not None)
+        assert_true(numpy.allclose(self.best, nn.get_parameters()[0].weights))
+        return nn
+
+    def test_DeviceMode(self):
+        nn = self.check('device')
+        assert_true(nn._backend.snapshot is not None)
+
+    def test_HostMode(self):
+        nn = self.check('host')
+        assert_true(nn._backend.snapshot is None)
+
+    def test_DiskMode(self):
+        nn = self.check('disk')
+        assert_true(nn._backend.snapshot is None)
+
+    def test_DiskModeRemovesDirectories(self):
+        from sknn.backend.lasagne import mlp as backend
+        self.check('disk')
+        self.check('disk')
+        assert_equals(set(), backend._snapshot_dirs)
+
+
+class TestValidationCadence(unittest.TestCase):
+
+    def setUp(self):
+        self.errors, self.batches = [], []
+
+    def _epoch(self, avg_valid_error, **_):
+        self.errors.append(avg_valid_error)
+
+    def _batch(self, mode, **_):
+        if mode == 'valid':
+            self.batches[-1] += 1
+
+    def fit(self, **kwargs):
+        callback = {'on_epoch_start': lambda **_: self.batches.append(0),
+                    'on_epoch_finish': self._epoch, 'on_batch_start': self._batch}
+        nn = MLPR(layers=[L("Linear")], n_iter=4, valid_size=0.5, callback=callback, **kwargs)
+        nn.fit(numpy.random.uniform(-1.0, +1.0, (40,4)), numpy.zeros((40,2)))
+        return nn
+
+    def test_ValidEvery(self):
+        self.fit(valid_every=2)
+        assert_equals([True, False, True, False], [e is None for e in self.errors])
+
+    def test_ValidSamples(self):
+        self.fit(valid_samples=5)
+        assert_equals(25, self.batches[0])
+        assert_true(all(b in (5, 25) for b in self.batches))
+
+    def test_ValidSamplesKeptSeparate(self):
+        samples = []
+        callback = {'on_epoch_finish': lambda sample_valid_error, avg_valid_error, **_:
+                                           samples.append((sample_valid_error, avg_valid_error))}
+        nn = MLPR(layers=[L("Linear")], n_iter=4, valid_size=0.5, valid_samples=5,
+                  learning_rate=0.0, callback=callback)
+        nn.fit(numpy.random.uniform(-1.0, +1.0, (40,4)), numpy.zeros((40,2)))
+        assert_true(all(s is not None for s, _ in samples))
+        assert_true(samples[0][1] is not None)
+        assert_true(samples[0][0] != samples[0][1])
+
+    def test_ValidSamplesLargerThanSet(self):
+        self.fit(valid_samples=100)
+        assert_equals([20] * 4, self.batches)
+
+    def test_StableCountsValidations(self):
+        nn = MLPR(layers=[L("Linear")], n_iter=20, n_stable=2, valid_every=3, valid_size=0.5,
+                  learning_rate=0.0, callback={'on_epoch_finish': self._epoch})
+        nn.fit(numpy.zeros((20,4)), numpy.zeros((20,2)))
+        assert_equals(6, len(self.errors))
+
+
+class TestLossAccumulation(unittest.TestCase):
+
+    def setUp(self):
+        self.a_in = numpy.random.uniform(-1.0, +1.0, (8,4)).astype(theano.config.floatX)
+        self.a_out = numpy.random.uniform(-1.0, +1.0, (8,2)).astype(theano.config.floatX)
+
+    def test_PartialBatchWeighted(self):
+        nn = MLPR(layers=[L("Linear")], n_iter=1, batch_size=3)
+        nn.fit(self.a_in, self.a_out)
+        expected = ((nn.predict(self.a_in) - self.a_out) ** 2).mean()
+        numpy.testing.assert_allclose(expected, nn._backend._valid_impl(self.a_in, self.a_out), rtol=1e-4)
+
+    def test_RunningLossOnRequest(self):
+        losses = []
+        nn = MLPR(layers=[L("Linear")], n_iter=1, batch_size=4,
+                  callback={'on_batch_finish': lambda running_loss, **_: losses.append(running_loss())})
+        nn.fit(self.a_in, self.a_out)
+        assert_equals(2, len(losses))
+        assert_true(all(l >= 0.0 for l in losses))
+
+    def test_LargeEpochsAccurate(self):
+        nn = MLPR(layers=[L("Linear")], n_iter=1)
+        nn._initialize(self.a_in, self.a_out)
+        backend = nn._backend
+        cost = theano.tensor.scalar(dtype=theano.config.floatX)
+        accumulate = theano.function([cost], updates=backend._accumulate_loss(cost, 1))
+
+        # Continue from the partial sums of 2^25 samples, beyond the precision of float32.
+        backend.loss_accumulator.set_value(numpy.float64(0.1 * 2**25))
+        backend.loss_count = 2**25
+        for _ in range(1000):
+            accumulate(0.1)
+            backend.loss_count += 1
+        numpy.testing.assert_allclose(0.1, backend._read_loss(), rtol=1e-6)
+
+
+class TestCheckpoints(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.a_in = numpy.random.uniform(-1.0, +1.0, (16,4))
+        self.a_out = numpy.random.uniform(-1.0, +1.0, (16,2))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self):
+        with open(os.path.join(self.directory, 'checkpoint.pkl'), 'rb') as f:
+            return pickle.load(f)
+
+    def test_CheckpointEveryEpochs(self):
+        nn = linear(n_iter=3, learning_rule='adam', checkpoint_dir=self.directory, checkpoint_epochs=2)
+        nn.fit(self.a_in, self.a_out)
+        assert_equals(2, self.load()['loop']['i'])
+
+    def test_ResumeSameAsContinuous(self):
+        nn1 = linear(n_iter=4, learning_rule='adam')
+        nn1.fit(self.a_in, self.a_out)
+        nn2 = linear(n_iter=2, learning_rule='adam', checkpoint_dir=self.directory,
+                     checkpoint_epochs=1)
+        nn2.fit(self.a_in, self.a_out)
+        nn3 = linear(n_iter=4, learning_rule='adam', resume_from=self.directory)
+        nn3.fit(self.a_in, self.a_out)
+        p1, p3 = nn1.get_parameters(), nn3.get_parameters()
+        assert_true(numpy.allclose(p1[0].weights, p3[0].weights, atol=1E-5))
+
+    def test_ResumeMissingCheckpoint(self):
+        nn = linear(n_iter=1, learning_rule='adam',
+                    resume_from=os.path.join(self.directory, 'missing'))
+        nn.fit(self.a_in, self.a_out)
+
+    def test_CheckpointOnTermination(self):
+        signals = []
+        previous = signal.signal(signal.SIGTERM, lambda *args: signals.append(args[0]))
+        try:
+            nn = linear(n_iter=4, learning_rule='adam', checkpoint_dir=self.directory,
+                        callback={'on_batch_finish': lambda **_: os.kill(os.getpid(), signal.SIGTERM)})
+            nn.fit(self.a_in, self.a_out)
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+        assert_equals([signal.SIGTERM], signals)
+        assert_equals(0, self.load()['loop']['i'])
+
+    def test_ResumeAfterTermination(self):
+        batches = []
+        def interrupt(**_):
+            batches.append(None)
+            if len(batches) == 5:
+                os.kill(os.getpid(), signal.SIGTERM)
+
+        nn1 = linear(n_iter=4, learning_rule='adam', epoch_size=8)
+        nn1.fit(self.a_in, self.a_out)
+        previous = signal.signal(signal.SIGTERM, lambda *args: None)
+        try:
+            nn2 = linear(n_iter=4, learning_rule='adam', epoch_size=8, checkpoint_dir=self.directory,
+                         callback={'on_batch_finish': interrupt})
+            nn2.fit(self.a_in, self.a_out)
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+        assert_equals(2, self.load()['loop']['i'])
+        assert_equals(1, self.load()['position']['batches'])
+
+        nn3 = linear(n_iter=4, learning_rule='adam', epoch_size=8, resume_from=self.directory)
+        nn3.fit(self.a_in, self.a_out)
+        p1, p3 = nn1.get_parameters(), nn3.get_parameters()
+        assert_true(numpy.allclose(p1[0].weights, p3[0].weights, atol=1E-5))
+
+    def test_TerminationDuringValidation(self):
+        epochs = []
+        def interrupt(mode, **_):
+            if mode == 'valid' and len(epochs) == 1:
+                os.kill(os.getpid(), signal.SIGTERM)
+        previous = signal.signal(signal.SIGTERM, lambda *args: None)
+        try:
+            nn = linear(n_iter=2, learning_rule='adam', checkpoint_dir=self.directory,
+                        valid_set=(self.a_in, self.a_out),
+                        callback={'on_batch_start': interrupt,
+                                  'on_epoch_finish': lambda i, **_: epochs.append(i)})
+            nn.fit(self.a_in, self.a_out)
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+        assert_equals([1, 2], epochs)
+        assert_equals(2, self.load()['loop']['i'])
+        assert_true('position' not in self.load())
+
+
+class TestPartialFit(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+
+    def _batch(self, mode, **_):
+        self.batches.append(mode)
+
+    def test_SinglePass(self):
+        nn = MLPR(layers=[L("Linear")], n_iter=10, batch_size=4, callback={'on_batch_start': self._batch})
+        nn.partial_fit(numpy.zeros((8,4)), numpy.zeros((8,2)))
+        nn.partial_fit(numpy.zeros((12,4)), numpy.zeros((12,2)))
+        assert_equals(['train'] * 5, self.batches)
+
+    def test_ValidateOnRequest(self):
+        a_in, a_out = numpy.zeros((8,4)), numpy.zeros((8,2))
+        nn = MLPR(layers=[L("Linear")], batch_size=4, valid_set=(a_in, a_out), callback={'on_batch_start': self._batch})
+        nn.partial_fit(a_in, a_out)
+        nn.partial_fit(a_in, a_out, validate=True)
+        assert_equals(['train'] * 4 + ['valid'] * 2, self.batches)
+
+    def test_NoValidSize(self):
+        nn = MLPR(layers=[L("Linear")], valid_size=0.25)
+        assert_raises(AssertionError, nn.partial_fit, numpy.zeros((8,4)), numpy.zeros((8,2)))
+
+    def test_EachSampleOnce(self):
+        excerpts = []
+        def store(excerpt, **_):
+            excerpts.extend(numpy.arange(8)[excerpt])
+        for kwargs in [dict(sampling='weighted'), dict(sampling='loss'), dict(epoch_size=2)]:
+            del excerpts[:]
+            nn = MLPR(layers=[L("Linear")], batch_size=3, callback={'on_batch_start': store}, **kwargs)
+            nn.partial_fit(numpy.zeros((8,4)), numpy.zeros((8,2)), numpy.ones((8,)))
+            assert_equals(list(range(8)), sorted(excerpts))
+
+    def test_LossTableUnchanged(self):
+        a_in, a_out = numpy.random.uniform(-1.0, +1.0, (8,4)), numpy.random.uniform(-1.0, +1.0, (8,2))
+        nn = MLPR(layers=[L("Linear")], n_iter=1, batch_size=3, sampling='loss')
+        nn.fit(a_in, a_out)
+        table = nn._backend.loss_table.copy()
+        nn.partial_fit(a_in[:4], a_out[:4])
+        assert_true((table == nn._backend.loss_table).all())
+
+    def test_CallbacksRefreshed(self):
+        nn = MLPR(layers=[L("Linear")], batch_size=4)
+        nn.partial_fit(numpy.zeros((8,4)), numpy.zeros((8,2)))
+        nn.callback = {'on_batch_start': self._batch}
+        nn.partial_fit(numpy.zeros((8,4)), numpy.zeros((8,2)))
+        assert_equals(['train'] * 2, self.batches)
+
+
+class TestTimeBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.epochs = []
+
+    def _slow_batch(self, **_):
+        time.sleep(0.05)
+
+    def fit(self, **kwargs):
+        # The budget includes compiling the network, so do that first for predictable timings.
+        a_in, a_out = numpy.zeros((8,4)), numpy.zeros((8,2))
+        nn = MLPR(layers=[L("Linear")], batch_size=2, n_stable=None,
+                  callback={'on_batch_start': self._slow_batch,
+                            'on_epoch_finish': lambda i, **_: self.epochs.append(i)}, **kwargs)
+        nn._initialize(a_in, a_out)
+        start = time.time()
+        nn.fit(a_in, a_out)
+        return time.time() - start
+
+    def test_StopsAtCompleteEpoch(self):
+        elapsed = self.fit(max_time=0.5)
+        assert_true(elapsed < 0.5)
+        assert_true(1 <= len(self.epochs) <= 2)
+
+    def test_StopsDuringEpoch(self):
+        elapsed = self.fit(max_time=0.12)
+        assert_true(elapsed < 0.2)
+        assert_equals([], self.epochs)
+
+    def test_IterationsStillApply(self):
+        self.fit(max_time=60.0, n_iter=2)
+        assert_equals([1, 2], self.epochs)
+
+
 class TestCustomLogging(unittest.TestCase):
 
     def setUp(self):
@@ -141,6 +700,12 @@ class TestTrainingOutput(unittest.TestCase):
         assert_in("    1       ", self.buf.getvalue())
         assert_in("    N/A     ", self.buf.getvalue())
 
+    def test_PeakMemoryReported(self):
+        nn = MLPR(layers=[L("Linear")], verbose=1, n_iter=1)
+        a_in, a_out = numpy.zeros((8,16)), numpy.zeros((8,4))
+        nn.fit(a_in, a_out)
+        assert_in("Peak resident memory reached", self.buf.getvalue())
+
     def test_CaughtRuntimeError(self):
         nn = MLPC(layers=[L("Linear")], learning_rate=float("nan"), n_iter=1)
         a_in, a_out = numpy.zeros((8,16)), numpy.zeros((8,1), dtype=numpy.int32)
@@ -12,7 +12,9 @@ import theano
 import scipy.sparse
 
 from sknn.mlp import MultiLayerPerceptron as MLP
+from sknn.mlp import Regressor as R, Classifier as K
 from sknn.mlp import Layer as L, Convolution as C
+from sknn.data import SlidingWindows
 
 
 # Sparse matrix must support indexing.  Other types but these do not work for this reason.
@@ -78,6 +80,42 @@ class TestScipySparseMatrix(unittest.TestCase):
             assert_equal(yp.dtype, numpy.float32)
 
 
+class TestSparseInput(unittest.TestCase):
+
+    def setUp(self):
+        self.nn = MLP(layers=[L("Rectifier", units=8), L("Linear", units=4)],
+                      n_iter=1, random_state=1234, sparse_input=True)
+
+    def test_FitPredictAllTypes(self):
+        for t in SPARSE_TYPES:
+            sparse_matrix = getattr(scipy.sparse, t)
+            X = sparse_matrix((8, 16), dtype=numpy.float32)
+            X[0, 1], X[3, 7] = 1.0, 2.0
+            y = numpy.zeros((8, 4), dtype=numpy.float32)
+            self.nn._fit(X, y)
+            assert_equal((8, 4), self.nn._predict(X).shape)
+
+    def test_BatchesStaySparse(self):
+        def check(Xb, **_):
+            assert_true(scipy.sparse.isspmatrix_csr(Xb))
+        self.nn.callback = {'on_batch_start': check}
+        X = scipy.sparse.csr_matrix((8, 16), dtype=numpy.float64)
+        self.nn._fit(X, numpy.zeros((8, 4)))
+
+    def test_SameAsDense(self):
+        X = scipy.sparse.random(8, 16, density=0.25, format='csr', dtype=numpy.float32)
+        nn = MLP(layers=[L("Rectifier", units=8), L("Linear", units=4)], n_iter=1, random_state=1234)
+        nn._initialize(X.toarray(), numpy.zeros((8, 4)))
+        self.nn._initialize(X, numpy.zeros((8, 4)))
+        self.nn.set_parameters(nn.get_parameters())
+        assert_true(numpy.allclose(nn._predict(X.toarray()), self.nn._predict(X), atol=1E-5))
+
+    def test_DropoutUnsupported(self):
+        nn = MLP(layers=[L("Linear", units=4)], dropout_rate=0.5, sparse_input=True)
+        X = scipy.sparse.csr_matrix((8, 16), dtype=numpy.float32)
+        assert_raises(AssertionError, nn._fit, X, numpy.zeros((8, 4)))
+
+
 class TestMemoryMap(unittest.TestCase):
 
     __types__ = ['float32', 'float64']
@@ -107,6 +145,40 @@ class TestMemoryMap(unittest.TestCase):
             yp = self.nn._predict(X)
 
 
+class TestMemoryMapFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.X = os.path.join(self.directory, 'X.npy')
+        self.y = os.path.join(self.directory, 'y.npy')
+        numpy.save(self.X, numpy.random.uniform(-1.0, 1.0, size=(20, 3)))
+        numpy.save(self.y, numpy.zeros((20, 2)))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_FitPredictFilenames(self):
+        nn = MLP(layers=[L("Linear")], n_iter=1)
+        nn._fit(self.X, self.y)
+        assert_equal((20, 2), nn._predict(self.X).shape)
+
+    def test_ValidationByIndex(self):
+        nn = MLP(layers=[L("Linear")], n_iter=1, valid_size=0.25)
+        nn._fit(self.X, self.y)
+        train, valid = nn._backend.train_split[1], nn._backend.valid_split[1]
+        assert_equal(15, len(train))
+        assert_equal(5, len(valid))
+        assert_equal(list(range(20)), sorted(numpy.concatenate([train, valid])))
+        assert_true(isinstance(nn.valid_set[0], numpy.memmap))
+
+    def test_ChunkShuffleComplete(self):
+        nn = MLP(layers=[L("Linear")], n_iter=1)
+        nn._initialize(numpy.zeros((20, 3)), numpy.zeros((20, 2)))
+        excerpts = list(nn._backend._iterate_excerpts(2, 20, 'chunk', chunk=6))
+        assert_true(all(len(e) <= 2 for e in excerpts))
+        assert_equal(list(range(20)), sorted(numpy.concatenate(excerpts)))
+
+
 class TestPandasDataFrame(TestMemoryMap):
     
     __types__ = ['float32']
@@ -115,6 +187,141 @@ class TestPandasDataFrame(TestMemoryMap):
         return pandas.DataFrame(numpy.random.uniform(-1.0, 1.0, size=shape), dtype=dtype)
 
 
+class TestPandasConversion(unittest.TestCase):
+
+    def setUp(self):
+        self.nn = MLP(layers=[L("Linear", units=3)], n_iter=1, random_state=1234)
+        self.X = pandas.DataFrame(numpy.random.uniform(-1.0, 1.0, size=(12, 3)),
+                                  columns=['a', 'b', 'c'], index=numpy.arange(100, 112))
+        self.y = numpy.zeros((12, 3))
+
+    def test_ConvertOnceNoCopy(self):
+        X = self.X.astype(theano.config.floatX)
+        Xa, _, _ = self.nn._convert_frames(X, fit=True)
+        assert_true(isinstance(Xa, numpy.ndarray))
+        assert_true(numpy.may_share_memory(Xa, X.values))
+        assert_equal(['a', 'b', 'c'], self.nn.feature_names)
+
+    def test_FitCustomIndex(self):
+        self.nn._fit(self.X, pandas.DataFrame(self.y, index=self.X.index))
+        assert_equal(['a', 'b', 'c'], self.nn.feature_names)
+
+    def test_PredictReordered(self):
+        self.nn._fit(self.X, self.y)
+        y1 = self.nn._predict(self.X)
+        y2 = self.nn._predict(self.X[['c', 'a', 'b']])
+        assert_true(numpy.allclose(y1, y2))
+
+    def test_PredictMissingColumn(self):
+        self.nn._fit(self.X, self.y)
+        assert_raises(ValueError, self.nn._predict, self.X[['a', 'b']])
+
+
+class TestCompactInput(unittest.TestCase):
+
+    def make(self, **kwargs):
+        return MLP(layers=[C("Rectifier", kernel_shape=(3,3), channels=4), L("Linear", units=2)],
+                   n_iter=1, random_state=1234, **kwargs)
+
+    def test_FitPredictAllTypes(self):
+        for t in ['uint8', 'uint16']:
+            X = numpy.random.randint(0, 255, size=(8,6,6,1)).astype(t)
+            nn = self.make(input_scale=1.0/255.0)
+            nn._fit(X, numpy.zeros((8,2)))
+            assert_equal(t, nn._backend.input_dtype)
+            assert_equal((8,2), nn._predict(X).shape)
+
+    def test_BatchesStayCompact(self):
+        def check(Xb, **_):
+            assert_equal(numpy.uint8, Xb.dtype)
+        nn = self.make(input_scale=1.0/255.0, callback={'on_batch_start': check})
+        nn._fit(numpy.zeros((8,6,6,1), dtype=numpy.uint8), numpy.zeros((8,2)))
+
+    def test_SameAsScaledFloat(self):
+        X = numpy.random.randint(0, 255, size=(8,6,6,1)).astype(numpy.uint8)
+        nn1 = self.make(input_scale=1.0/255.0, input_offset=-0.5)
+        nn1._initialize(X, numpy.zeros((8,2)))
+        nn2 = self.make()
+        nn2._initialize(X / 255.0 - 0.5, numpy.zeros((8,2)))
+        nn2.set_parameters(nn1.get_parameters())
+        assert_true(numpy.allclose(nn1._predict(X), nn2._predict(X / 255.0 - 0.5), atol=1E-5))
+
+    def test_PredictFloatFails(self):
+        nn = self.make()
+        nn._fit(numpy.zeros((8,6,6,1), dtype=numpy.uint8), numpy.zeros((8,2)))
+        assert_raises(AssertionError, nn._predict, numpy.zeros((8,6,6,1)))
+
+
+class TestDtypePolicy(unittest.TestCase):
+
+    def setUp(self):
+        theano.config.floatX = 'float32'
+        self.X = numpy.random.uniform(-1.0, +1.0, size=(16,4))
+        self.y = numpy.zeros((16,2), dtype=numpy.float32)
+
+    def make(self, policy):
+        return MLP(layers=[L("Linear")], n_iter=1, shuffle_mode=None, dtype_policy=policy)
+
+    def test_AutoConvertsBatches(self):
+        nn = self.make('auto')
+        nn._fit(self.X, self.y)
+        assert_equal(self.X.size * 4, nn.copied_bytes['batches'])
+        assert_equal(0, nn.copied_bytes['convert'])
+
+    def test_StrictRejects(self):
+        nn = self.make('strict')
+        assert_raises(ValueError, nn._fit, self.X, self.y)
+        nn._fit(self.X.astype(numpy.float32), self.y)
+        assert_equal(0, sum(nn.copied_bytes.values()))
+
+    def test_ConvertOnce(self):
+        nn = self.make('convert_once')
+        nn._fit(self.X, self.y)
+        assert_equal(self.X.size * 4, nn.copied_bytes['convert'])
+        assert_equal(0, nn.copied_bytes['batches'])
+
+    def test_ConvertInPlace(self):
+        nn = self.make('convert_inplace')
+        X = self.X.copy()
+        Xc, _, _ = nn._convert_dtypes(X)
+        assert_true(numpy.may_share_memory(X, Xc))
+        assert_true(numpy.allclose(Xc, self.X, atol=1E-6))
+        nn._fit(Xc, self.y)
+        assert_equal(0, sum(nn.copied_bytes.values()))
+
+    def test_StrictRejectsFrames(self):
+        nn = self.make('strict')
+        assert_raises(ValueError, nn._fit, pandas.DataFrame(self.X), self.y)
+        nn._fit(pandas.DataFrame(self.X.astype(numpy.float32)), self.y)
+        assert_equal(0, sum(nn.copied_bytes.values()))
+
+    def test_ConvertOnceFrames(self):
+        nn = self.make('convert_once')
+        nn._fit(pandas.DataFrame(self.X), self.y)
+        assert_equal(self.X.size * 4, nn.copied_bytes['convert'])
+        assert_equal(0, nn.copied_bytes['frames'])
+
+    def test_ConvertOnceWindows(self):
+        nn = R(layers=[L("Linear")], n_iter=1, batch_size=4, dtype_policy='convert_once')
+        nn.fit(SlidingWindows(numpy.random.uniform(-1.0, +1.0, (64,3)), window=8))
+        # Only the targets are converted, the windows of inputs are cast for each batch.
+        assert_true(nn.copied_bytes['convert'] <= 64 * 3 * 4)
+        assert_true(nn.copied_bytes['batches'] > 0)
+
+    def test_ValidSetCounted(self):
+        nn = R(layers=[L("Linear")], n_iter=1, dtype_policy='convert_once', valid_set=(self.X, self.y))
+        nn.fit(self.X.astype(numpy.float32), self.y)
+        assert_equal(self.X.size * 4, nn.copied_bytes['valid'])
+        assert_equal(0, nn.copied_bytes['convert'])
+
+    def test_LabelsCounted(self):
+        y = numpy.random.randint(0, 2, size=(16,))
+        nn = K(layers=[L("Softmax")], n_iter=1, valid_set=(self.X.astype(numpy.float32), y))
+        nn.fit(self.X.astype(numpy.float32), y)
+        assert_equal(16 * 2 * 4, nn.copied_bytes['labels'])
+        assert_equal(16 * 2 * 4, nn.copied_bytes['valid'])
+
+
 class TestConvolution(unittest.TestCase):
 
     def setUp(self):